@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Provides DistanceCache class"""
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+__author__ = "Rafael Gonçalves, Stanford University"
+
+
+class DistanceCache:
+
+    # distance matrices are stored as .npy files in cache_folder, named after a hash of their tokens, distance metric
+    # and n-gram size. when the files take more than max_size bytes, the least recently used ones are evicted
+    def __init__(self, cache_folder, max_size):
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        os.makedirs(cache_folder, exist_ok=True)
+        logging.basicConfig(level=logging.INFO)
+
+    # returns a hash of the set of tokens, the distance metric and the n-gram size
+    @staticmethod
+    def get_key(tokens, distance_metric, ngrams):
+        digest = hashlib.sha256()
+        digest.update((distance_metric + "\n" + str(ngrams) + "\n").encode())
+        for token in sorted(tokens):
+            digest.update((token + "\n").encode())
+        return digest.hexdigest()
+
+    def get_file(self, key):
+        return os.path.join(self.cache_folder, key + ".npy")
+
+    # matrices are cached with their rows in sorted token order. returns the position of each of the given tokens in
+    # that order, or None if the tokens are already sorted
+    @staticmethod
+    def get_ranks(tokens):
+        order = sorted(range(len(tokens)), key=lambda i: tokens[i])
+        if order == list(range(len(tokens))):
+            return None
+        ranks = np.empty(len(tokens), dtype=np.intp)
+        ranks[order] = np.arange(len(tokens))
+        return ranks
+
+    # returns the cached distances matrix for the given tokens, as a read-only memory map if the tokens are sorted,
+    # or None if it is not in the cache
+    def load(self, tokens, distance_metric, ngrams):
+        cache_file = self.get_file(self.get_key(tokens, distance_metric, ngrams))
+        if not os.path.exists(cache_file):
+            return None
+        logging.info("Loading cached distances matrix: " + cache_file)
+        os.utime(cache_file)  # mark as most recently used
+        distances = np.load(cache_file, mmap_mode='r')
+        ranks = self.get_ranks(tokens)
+        if ranks is not None:
+            distances = distances[np.ix_(ranks, ranks)]
+        return distances
+
+    # adds the distances matrix of the given tokens to the cache, and evicts the least recently used matrices that
+    # no longer fit in it
+    def store(self, tokens, distance_metric, ngrams, distances):
+        if distances.nbytes > self.max_size:
+            logging.info("Distances matrix of " + str(distances.nbytes) + " bytes exceeds the cache size")
+            return
+        cache_file = self.get_file(self.get_key(tokens, distance_metric, ngrams))
+        ranks = self.get_ranks(tokens)
+        if ranks is not None:
+            order = np.argsort(ranks)
+            distances = distances[np.ix_(order, order)]
+        # write under a temporary name so that concurrent runs never load a partially written matrix
+        with open(cache_file + ".part", "wb") as f:
+            np.save(f, distances)
+        os.replace(cache_file + ".part", cache_file)
+        logging.info("Cached distances matrix: " + cache_file)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_folder):
+            if name.endswith(".npy"):
+                cache_file = os.path.join(self.cache_folder, name)
+                entries.append((os.path.getmtime(cache_file), os.path.getsize(cache_file), cache_file))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, cache_file in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logging.info("Evicting cached distances matrix: " + cache_file)
+            os.remove(cache_file)
+            total_size -= size
@@ -17,12 +17,13 @@ clustering=('ap' 'ms' 'dbscan' 'hdbscan')
 # n for n-grams based distance metrics
 ngrams=4
 
-for cluster in ${clustering[@]}
-do
-    for dist in ${distances[@]}
-    do
-        echo "Clustering input using $cluster according to $dist distance between data points"
-        python3 stringclusters.py -i $input -o $output -d $dist -c $cluster -n $ngrams
-        echo "done\n"
-    done
-done
\ No newline at end of file
+# distance matrices are cached across runs, so that later runs over the same input do not recompute them
+cache=./cluster_cache/
+
+# number of worker processes
+workers=$(nproc)
+
+echo "Clustering input using ${clustering[@]} according to ${distances[@]} distances between data points"
+python3 stringclusters.py -i $input -o $output -d ${distances[@]} -c ${clustering[@]} -n $ngrams -w $workers \
+    -k $cache
+echo "done"
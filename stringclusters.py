@@ -14,22 +14,34 @@ Example usage:
 
     Cluster the list of strings in a file named "foods.txt" using Euclidean distance:
     >> python stringclusters.py -i foods.txt -d euclidean
+
+    Cluster the list of strings in a file named "foods.txt" with DBSCAN and HDBSCAN, according to both Jaro and
+    Jaccard distances, using 4 worker processes:
+    >> python stringclusters.py -i foods.txt -d jaro jaccard -c dbscan hdbscan -w 4
     ```
 """
 
 import argparse
+import csv
 import datetime
 import logging
 import os
 import sys
 import time
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from multiprocessing.shared_memory import SharedMemory
 
 import hdbscan
 import numpy as np
+import scipy.sparse
+import scipy.cluster.hierarchy
+import scipy.sparse.csgraph
+import scipy.spatial.distance
 import sklearn.cluster
-from stringdistance import Distance, StringDistance
+from distancecache import DistanceCache
+from stringdistance import Distance, Kernel, StringDistance
+from stringembedding import StringEmbedding
 from stringnormalize import StringNormalize
 from stringutils import StringUtils
 
@@ -41,49 +53,376 @@ class Algorithm(Enum):
     DBSCAN = 'dbscan'
     HDBSCAN = 'hdbscan'
     MEAN_SHIFT = 'ms'
+    HIERARCHICAL = 'hierarchical'
+
+
+class MatrixFormat(Enum):
+    CSV = 'csv'
+    NPY = 'npy'
+    NPZ = 'npz'
+    SPARSE = 'sparse'
+    NONE = 'none'
+
+
+class ClustersFormat(Enum):
+    JSON = 'json'
+    COMPACT_JSON = 'compact'
+    JSON_LINES = 'jsonl'
+
+
+class Linkage(Enum):
+    SINGLE = 'single'
+    AVERAGE = 'average'
+    COMPLETE = 'complete'
+
+
+class Collapse(Enum):
+    WORDS = 'words'
+    SPACES = 'spaces'
+
+
+# name given to the clusters of embedded tokens in place of a distance metric
+EMBEDDING = 'embedding'
 
 
 class StringClusters:
 
-    def __init__(self, output_folder):
+    # if out_of_core is set, distance matrices are memory-mapped from .npy files in the output folder instead of being
+    # held in memory, and are reused by later runs over the same strings. if sparse is set, DBSCAN only gets the
+    # distances within its eps neighborhood, and affinity propagation those within max_distance, as a sparse matrix. if
+    # a DistanceCache is given, distance matrices are reused across runs over the same strings. kernel selects the
+    # implementation of the distances (see Kernel). if approximate is set, DBSCAN, HDBSCAN and affinity propagation get
+    # sparse jaccard or cosine distances approximated with MinHash signatures of num_perm values split into bands,
+    # skipping band buckets of more than max_bucket_size strings (see StringDistance.get_approximate_distances), within
+    # the eps neighborhood for DBSCAN and within max_distance for the others. if ap_neighbors is set, affinity
+    # propagation only passes messages between each string and its ap_neighbors nearest neighbors (among those within
+    # max_distance, with sparse or approximate distances). if a StringEmbedding is given, DBSCAN (with embedding_eps)
+    # and HDBSCAN cluster the embedded tokens rather than their distances. mean shift clusters a meanshift_dimensions
+    # embedding of the distances (see StringEmbedding.get_landmark_vectors), with bin seeding. hierarchical clustering
+    # builds a single dendrogram with the given linkage (see Linkage), and cuts it at each of the given distance
+    # thresholds (by default, at the DBSCAN eps of the distance metric). distance matrices are saved in matrix_format
+    # (see MatrixFormat), and clusters dictionaries in clusters_format (see ClustersFormat). if collapse is set, tokens
+    # with the same canonical form (see Collapse) are clustered as a single representative token, weighted by their
+    # number for DBSCAN, and every cluster is expanded back to all of them. if update is set (with out_of_core), the
+    # out-of-core matrices of an earlier run over other strings are updated to the new strings rather than recomputed
+    def __init__(self, output_folder, workers=1, out_of_core=False, sparse=False, cache=None,
+                 kernel=Kernel.JELLYFISH.value, approximate=False, num_perm=128, bands=32, max_distance=50,
+                 ap_neighbors=None, embedding=None, embedding_eps=0.5, meanshift_dimensions=32,
+                 linkage=Linkage.SINGLE.value, thresholds=None, matrix_format=MatrixFormat.CSV.value,
+                 clusters_format=ClustersFormat.JSON.value, collapse=None, update=False, max_bucket_size=1000):
         self.output_folder = output_folder
+        self.workers = workers
+        self.out_of_core = out_of_core
+        self.sparse = sparse
+        self.cache = cache
+        self.kernel = kernel
+        self.approximate = approximate
+        self.num_perm = num_perm
+        self.bands = bands
+        self.max_distance = max_distance
+        self.ap_neighbors = ap_neighbors
+        self.embedding = embedding
+        self.embedding_eps = embedding_eps
+        self.meanshift_dimensions = meanshift_dimensions
+        self.linkage = linkage
+        self.thresholds = thresholds
+        self.matrix_format = matrix_format
+        self.clusters_format = clusters_format
+        self.collapse = collapse
+        self.update = update
+        self.max_bucket_size = max_bucket_size
         logging.basicConfig(level=logging.INFO)
 
     # cluster the given tokens according to their similarity distances using affinity propagation.
     # returns a dictionary that maps each cluster exemplar to an array of cluster elements (incl. exemplar)
     def cluster_affinity_propagation(self, distances, tokens):
+        if self.ap_neighbors is not None or scipy.sparse.issparse(distances):
+            return self.cluster_sparse_affinity_propagation(distances, tokens)
         start_time = time.time()
 
-        ap = sklearn.cluster.AffinityPropagation(affinity="precomputed", damping=0.8)
-        ap.fit(-1 * distances)  # input to affinity propagation is an array of similarities
+        labels, centers_indices = self.run_dense_affinity_propagation(distances, damping=0.8)
 
         end_time = time.time()
         logging.info("Affinity propagation clustering time: " + str(round(end_time-start_time, 2)) + " seconds")
-        return self.build_ap_cluster_dictionary(ap.labels_, tokens, ap.cluster_centers_indices_)
+        return self.build_ap_cluster_dictionary(labels, tokens, centers_indices)
+
+    # runs affinity propagation (as in sklearn.cluster.AffinityPropagation, with the median similarity as preference)
+    # over a dense distances matrix, which may be memory-mapped. the similarities are read from the distances a block
+    # of rows at a time, and all messages are updated in place in four preallocated float32 buffers, rather than in
+    # the negated int64 copy and the float64 buffers sklearn allocates. returns the labels of the tokens and the
+    # indices of the exemplars
+    @staticmethod
+    def run_dense_affinity_propagation(distances, damping=0.5, max_iter=200, convergence_iter=15, block_size=1024):
+        size = distances.shape[0]
+        similarities = np.empty((size, size), dtype=np.float32)
+        random_state = np.random.RandomState(0)
+        for i0 in range(0, size, block_size):
+            block = similarities[i0:i0+block_size]
+            block[:] = distances[i0:i0+block_size]
+            np.negative(block, out=block)
+            # remove degeneracies between equal similarities, as sklearn does
+            block += ((np.finfo(np.float32).eps * block + np.finfo(np.float32).tiny * 100) *
+                      random_state.standard_normal(size=block.shape).astype(np.float32))
+        similarities.flat[::size + 1] = -StringClusters.get_median_distance(distances, block_size)
+
+        responsibilities = np.zeros((size, size), dtype=np.float32)
+        availabilities = np.zeros((size, size), dtype=np.float32)
+        buffer = np.empty((size, size), dtype=np.float32)
+        rows = np.arange(size)
+        exemplars_history = np.zeros((size, convergence_iter), dtype=bool)
+        for iteration in range(max_iter):
+            # responsibilities: r(i,k) = s(i,k) - max over k' != k of (a(i,k') + s(i,k'))
+            np.add(availabilities, similarities, out=buffer)
+            first_max = np.argmax(buffer, axis=1)
+            row_max = buffer[rows, first_max]
+            buffer[rows, first_max] = -np.inf
+            other_max = np.max(buffer, axis=1)
+            np.subtract(similarities, row_max[:, np.newaxis], out=buffer)
+            buffer[rows, first_max] = similarities[rows, first_max] - other_max
+            buffer *= 1 - damping
+            responsibilities *= damping
+            responsibilities += buffer
+
+            # availabilities: a(i,k) = min(0, r(k,k) + sum over i' not in {i,k} of max(0, r(i',k))), and
+            # a(k,k) = sum over i' != k of max(0, r(i',k))
+            np.maximum(responsibilities, 0, out=buffer)
+            buffer.flat[::size + 1] = responsibilities.flat[::size + 1]
+            buffer -= np.sum(buffer, axis=0)
+            self_availabilities = buffer.flat[::size + 1].copy()
+            np.clip(buffer, 0, np.inf, out=buffer)
+            buffer.flat[::size + 1] = self_availabilities
+            buffer *= 1 - damping
+            availabilities *= damping
+            availabilities -= buffer
+
+            exemplars = (availabilities.flat[::size + 1] + responsibilities.flat[::size + 1]) > 0
+            exemplars_history[:, iteration % convergence_iter] = exemplars
+            if iteration >= convergence_iter and exemplars.any() and \
+                    (exemplars_history.all(axis=1) | ~exemplars_history.any(axis=1)).all():
+                break
+        del responsibilities, availabilities, buffer
+
+        # each token goes to its most similar exemplar, and each cluster then takes as exemplar the member most
+        # similar to all the others
+        centers_indices = np.flatnonzero(exemplars)
+        if len(centers_indices) == 0:
+            return np.full(size, -1), centers_indices
+        labels = np.argmax(similarities[:, centers_indices], axis=1)
+        labels[centers_indices] = np.arange(len(centers_indices))
+        for k in range(len(centers_indices)):
+            members = np.flatnonzero(labels == k)
+            centers_indices[k] = members[np.argmax(np.sum(similarities[np.ix_(members, members)], axis=0))]
+        labels = np.argmax(similarities[:, centers_indices], axis=1)
+        labels[centers_indices] = np.arange(len(centers_indices))
+        centers_indices, labels = np.unique(centers_indices[labels], return_inverse=True)
+        return labels.ravel(), centers_indices
+
+    # returns the median of a dense matrix of integer distances, from the counts of each distance in each block of rows
+    @staticmethod
+    def get_median_distance(distances, block_size=1024):
+        if not np.issubdtype(distances.dtype, np.integer):
+            return float(np.median(distances))
+        counts = np.zeros(1, dtype=np.int64)
+        for i0 in range(0, distances.shape[0], block_size):
+            block_counts = np.bincount(np.asarray(distances[i0:i0+block_size]).ravel())
+            counts = np.pad(counts, (0, max(len(block_counts) - len(counts), 0)))
+            counts[:len(block_counts)] += block_counts
+        cumulative_counts = np.cumsum(counts)
+        size = cumulative_counts[-1]
+        # the median of an even number of distances is the mean of the two middle ones
+        return (np.searchsorted(cumulative_counts, (size - 1) // 2, side='right') +
+                np.searchsorted(cumulative_counts, size // 2, side='right')) / 2.0
+
+    # affinity propagation over a sparse graph of the ap_neighbors nearest neighbors of each token (or over the given
+    # sparse distances), so that memory and time grow with the number of edges rather than with the square of the
+    # number of tokens. returns a dictionary in the same format as cluster_affinity_propagation
+    def cluster_sparse_affinity_propagation(self, distances, tokens, damping=0.8, max_iter=200, convergence_iter=15):
+        start_time = time.time()
+
+        if self.ap_neighbors is not None:
+            distances = self.get_nearest_neighbors(distances, self.ap_neighbors)
+        labels, centers_indices = self.run_sparse_affinity_propagation(distances, damping, max_iter, convergence_iter)
+
+        end_time = time.time()
+        logging.info("Sparse affinity propagation clustering time: " + str(round(end_time-start_time, 2)) + " seconds")
+        return self.build_ap_cluster_dictionary(labels, tokens, centers_indices)
+
+    # returns a sparse (CSR) matrix with the distances from each token to its k nearest neighbors, and back, from a
+    # dense (possibly memory-mapped, as it is only read a block of rows at a time) or sparse distances matrix
+    @staticmethod
+    def get_nearest_neighbors(distances, k, block_size=1024):
+        size = distances.shape[0]
+        k = max(min(k, size - 1), 0)
+        rows, cols, data = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0)]
+        if scipy.sparse.issparse(distances):
+            distances = distances.tocsr()
+            for i in range(size):
+                neighbors = distances.indices[distances.indptr[i]:distances.indptr[i+1]]
+                neighbor_distances = distances.data[distances.indptr[i]:distances.indptr[i+1]]
+                nearest = np.argsort(np.where(neighbors == i, np.inf, neighbor_distances), kind='stable')[:k]
+                nearest = nearest[neighbors[nearest] != i]
+                rows.append(np.full(len(nearest), i, dtype=np.int64))
+                cols.append(neighbors[nearest].astype(np.int64))
+                data.append(neighbor_distances[nearest].astype(np.float64))
+        elif k > 0:
+            for i0 in range(0, size, block_size):
+                block = np.array(distances[i0:i0+block_size], dtype=np.float64)
+                # a token is not its own neighbor
+                block[np.arange(len(block)), np.arange(i0, i0 + len(block))] = np.inf
+                nearest = np.argpartition(block, k - 1, axis=1)[:, :k]
+                rows.append(np.repeat(np.arange(i0, i0 + len(block)), k))
+                cols.append(nearest.ravel().astype(np.int64))
+                data.append(np.take_along_axis(block, nearest, axis=1).ravel())
+        rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+        # the graph is made symmetric, keeping each pair once, so that both tokens of a pair exchange messages
+        rows, cols, data = np.r_[rows, cols], np.r_[cols, rows], np.r_[data, data]
+        _, unique = np.unique(rows * size + cols, return_index=True)
+        return scipy.sparse.csr_matrix((data[unique], (rows[unique], cols[unique])), shape=(size, size))
+
+    # runs the message passing of affinity propagation (as in sklearn.cluster.AffinityPropagation) only over the
+    # pairs of tokens stored in a sparse distances matrix. the preference of each token is the median similarity of
+    # the stored pairs, and each token is assigned to its most similar exemplar among its neighbors, or becomes an
+    # exemplar itself if it has none. returns the labels of the tokens and the indices of the exemplars
+    @staticmethod
+    def run_sparse_affinity_propagation(distances, damping, max_iter, convergence_iter):
+        size = distances.shape[0]
+        graph = scipy.sparse.coo_matrix(distances)
+        off_diagonal = graph.row != graph.col
+        rows = np.r_[graph.row[off_diagonal], np.arange(size)].astype(np.int64)
+        cols = np.r_[graph.col[off_diagonal], np.arange(size)].astype(np.int64)
+        similarities = -graph.data[off_diagonal].astype(np.float64)
+        preference = np.median(similarities) if len(similarities) else 0.0
+        similarities = np.r_[similarities, np.full(size, preference)]
+        # edges are grouped by row, and every row has at least its diagonal edge
+        order = np.lexsort((cols, rows))
+        rows, cols, similarities = rows[order], cols[order], similarities[order]
+        row_starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        column_order = np.argsort(cols, kind='stable')
+        column_starts = np.flatnonzero(np.r_[True, cols[column_order][1:] != cols[column_order][:-1]])
+        diagonal = np.flatnonzero(rows == cols)
+        # remove degeneracies between equal similarities, as sklearn does
+        random_state = np.random.RandomState(0)
+        similarities += ((np.finfo(np.float64).eps * similarities + np.finfo(np.float64).tiny * 100) *
+                         random_state.standard_normal(size=len(similarities)))
+
+        responsibilities = np.zeros(len(similarities))
+        availabilities = np.zeros(len(similarities))
+        exemplars_history = np.zeros((size, convergence_iter), dtype=bool)
+        for iteration in range(max_iter):
+            # responsibilities: r(i,k) = s(i,k) - max over k' != k of (a(i,k') + s(i,k'))
+            scores = availabilities + similarities
+            row_max = np.maximum.reduceat(scores, row_starts)
+            maxima = np.flatnonzero(scores == row_max[rows])
+            first_max = maxima[np.r_[True, rows[maxima][1:] != rows[maxima][:-1]]]
+            masked_scores = scores.copy()
+            masked_scores[first_max] = -np.inf
+            other_max = row_max[rows]
+            other_max[first_max] = np.maximum.reduceat(masked_scores, row_starts)
+            # tokens without neighbors (beyond max_distance of every other token) have no other candidate exemplar.
+            # they are left to become exemplars of their own (see below) rather than given an infinite responsibility,
+            # which would make the availabilities undefined
+            other_max[np.isneginf(other_max)] = 0
+            responsibilities = damping * responsibilities + (1 - damping) * (similarities - other_max)
+
+            # availabilities: a(i,k) = min(0, r(k,k) + sum over i' not in {i,k} of max(0, r(i',k))), and
+            # a(k,k) = sum over i' != k of max(0, r(i',k))
+            positive = np.maximum(responsibilities, 0)
+            positive[diagonal] = responsibilities[diagonal]
+            column_sums = np.add.reduceat(positive[column_order], column_starts)
+            new_availabilities = column_sums[cols] - positive
+            self_availabilities = new_availabilities[diagonal]
+            np.minimum(new_availabilities, 0, out=new_availabilities)
+            new_availabilities[diagonal] = self_availabilities
+            availabilities = damping * availabilities + (1 - damping) * new_availabilities
+
+            exemplars = (availabilities[diagonal] + responsibilities[diagonal]) > 0
+            exemplars_history[:, iteration % convergence_iter] = exemplars
+            if iteration >= convergence_iter and exemplars.any() and \
+                    (exemplars_history.all(axis=1) | ~exemplars_history.any(axis=1)).all():
+                break
+
+        # each token goes to its most similar neighboring exemplar, and exemplars to themselves
+        assignments = np.arange(size)
+        candidates = exemplars[cols] & ~exemplars[rows]
+        best = np.full(size, -np.inf)
+        np.maximum.at(best, rows[candidates], similarities[candidates])
+        chosen = candidates & (similarities == best[rows])
+        assignments[rows[chosen]] = cols[chosen]
+        centers_indices, labels = np.unique(assignments, return_inverse=True)
+        return labels.ravel(), centers_indices
 
     # HDBSCAN clustering
     def cluster_hdbscan(self, distances, tokens):
         start_time = time.time()
 
-        hdbscan_ = hdbscan.HDBSCAN(min_samples=6, min_cluster_size=2, metric='precomputed')
-        hdbscan_.fit(distances.astype(np.float64))
+        if scipy.sparse.issparse(distances):
+            # pairs missing from sparse distances are further apart than max_distance
+            hdbscan_ = hdbscan.HDBSCAN(min_samples=6, min_cluster_size=2, metric='precomputed',
+                                       max_dist=self.max_distance + 1)
+            hdbscan_.fit(self.get_connected_distances(distances, self.max_distance + 1))
+        else:
+            hdbscan_ = hdbscan.HDBSCAN(min_samples=6, min_cluster_size=2, metric='precomputed')
+            hdbscan_.fit(distances.astype(np.float64))
 
         end_time = time.time()
         logging.info("HDBSCAN clustering time: " + str(round(end_time-start_time, 2)) + " seconds")
         return self.build_cluster_dictionary(hdbscan_.labels_, tokens)
 
-    # DBSCAN clustering
-    def cluster_dbscan(self, distances, tokens, distance):
+    # HDBSCAN only accepts sparse distances that form a connected graph without zero distances. the connected
+    # components of the graph are chained together by edges of missing_distance, the distance HDBSCAN assumes for
+    # the pairs missing from the graph, so the components are only merged above every distance within them
+    @staticmethod
+    def get_connected_distances(distances, missing_distance):
+        distances = scipy.sparse.csr_matrix(distances, dtype=np.float64, copy=True)
+        distances.data[distances.data == 0] = np.nextafter(0, 1)
+        _, labels = scipy.sparse.csgraph.connected_components(distances, directed=False)
+        _, representatives = np.unique(labels, return_index=True)
+        chain = scipy.sparse.csr_matrix((np.full(len(representatives) - 1, missing_distance, dtype=np.float64),
+                                         (representatives[:-1], representatives[1:])), shape=distances.shape)
+        return (distances + chain + chain.T).tocsr()
+
+    # DBSCAN clustering. each token counts as the given weight of tokens towards the min_samples of a core token
+    def cluster_dbscan(self, distances, tokens, distance, weights=None):
         start_time = time.time()
 
         eps = self.get_eps_dbscan(distance)
         dbscan = sklearn.cluster.DBSCAN(eps=eps, min_samples=2, metric='precomputed')
-        dbscan.fit(distances)  # input is an array of distances
+        dbscan.fit(distances, sample_weight=weights)  # input is an array of distances
 
         end_time = time.time()
         logging.info("DBSCAN clustering time: " + str(round(end_time-start_time, 2)) + " seconds")
         return self.build_cluster_dictionary(dbscan.labels_, tokens)
 
+    # clusters embedded tokens with DBSCAN or HDBSCAN, which find the neighbors of each vector with a KD-tree rather
+    # than from a distances matrix, and saves the clusters dictionary (expanded to the members of collapsed tokens, if
+    # given). DBSCAN weighs each token by the given weights
+    def cluster_vectors(self, vectors, tokens, clustering_algorithm, weights=None, members=None):
+        start_time = time.time()
+
+        if clustering_algorithm == Algorithm.DBSCAN.value:
+            model = sklearn.cluster.DBSCAN(eps=self.embedding_eps, min_samples=2, algorithm='kd_tree',
+                                           n_jobs=self.workers)
+            model.fit(vectors, sample_weight=weights)
+        elif clustering_algorithm == Algorithm.HDBSCAN.value:
+            model = hdbscan.HDBSCAN(min_samples=6, min_cluster_size=2, metric='euclidean',
+                                    algorithm='boruvka_kdtree', core_dist_n_jobs=self.workers)
+            model.fit(vectors)
+        else:
+            raise ValueError("Embedded tokens are only supported by the '" + Algorithm.DBSCAN.value + "' and '" +
+                             Algorithm.HDBSCAN.value + "' algorithms")
+        labels = model.labels_.copy()
+        # tokens without n-grams have no similarity with any other token
+        labels[~vectors.any(axis=1)] = -1
+
+        end_time = time.time()
+        logging.info(clustering_algorithm.upper() + " clustering time (embedded tokens): " +
+                     str(round(end_time-start_time, 2)) + " seconds")
+        clusters = self.build_cluster_dictionary(labels, tokens)
+        if members is not None:
+            clusters = self.expand_clusters(clusters, members)
+        self.save_clusters(self.output_folder + "clusters_" + clustering_algorithm + "_" + EMBEDDING, clusters)
+        return clusters
+
     def get_eps_dbscan(self, distance):
         # eps of ~13.0 works well for jaro(-winkler) distances
         if distance == Distance.JARO.value or distance == Distance.JARO_WINKLER.value:
@@ -102,63 +441,410 @@ class StringClusters:
     def cluster_meanshift(self, distances, tokens):
         start_time = time.time()
 
-        bandwidth = sklearn.cluster.estimate_bandwidth(distances, quantile=0.2, n_samples=50)
-        # bandwith of ~140.0 works well for all distance metrics but levenshtein(-damerau)
-        # bandwith of ~23.0 works well for levenshtein(-damerau)
-        meanshift = sklearn.cluster.MeanShift(bandwidth=bandwidth, cluster_all=True)
-        meanshift.fit(distances)
+        # mean shift runs on a low-dimensional embedding of the rows of the matrix rather than on the whole rows (see
+        # StringEmbedding.get_landmark_vectors), which roughly preserves the distances between rows, so the bandwidth
+        # is still estimated at the same quantile of those distances. with bin seeding, only the few occupied bins of
+        # the embedding are shifted, so that each step costs time linear in the number of tokens
+        vectors = StringEmbedding(dimensions=self.meanshift_dimensions).get_landmark_vectors(distances)
+        bandwidth = sklearn.cluster.estimate_bandwidth(vectors, quantile=0.2, n_samples=min(len(vectors), 1000),
+                                                       random_state=0, n_jobs=self.workers)
+        meanshift = sklearn.cluster.MeanShift(bandwidth=bandwidth, bin_seeding=True, cluster_all=True,
+                                              n_jobs=self.workers)
+        meanshift.fit(vectors)
 
         end_time = time.time()
         logging.info("Mean shift clustering time: " + str(round(end_time-start_time, 2)) + " seconds")
         return self.build_cluster_dictionary(meanshift.labels_, tokens)
 
+    # hierarchical (agglomerative) clustering over a condensed distances vector (or a square matrix, which is condensed
+    # first). returns a dictionary that maps each distance threshold to the clusters dictionary of the dendrogram cut
+    # at that threshold, where every cluster only joins tokens merged at distances of at most the threshold
+    def cluster_hierarchical(self, distances, tokens, distance):
+        start_time = time.time()
+
+        if distances.ndim == 2:
+            distances = scipy.spatial.distance.squareform(distances, checks=False)
+        thresholds = self.thresholds if self.thresholds else [self.get_eps_dbscan(distance)]
+        if self.linkage == Linkage.SINGLE.value:
+            # single linkage clusters are the connected components of the edges of a minimum spanning tree within the
+            # threshold, so the tree is all that is kept of the dendrogram
+            rows, cols, weights = self.get_minimum_spanning_tree(distances, len(tokens))
+            all_labels = []
+            for threshold in thresholds:
+                within = weights <= threshold
+                graph = scipy.sparse.csr_matrix((np.ones(np.count_nonzero(within)), (rows[within], cols[within])),
+                                                shape=(len(tokens), len(tokens)))
+                all_labels.append(scipy.sparse.csgraph.connected_components(graph, directed=False)[1])
+        elif self.linkage in [Linkage.AVERAGE.value, Linkage.COMPLETE.value]:
+            dendrogram = scipy.cluster.hierarchy.linkage(distances, method=self.linkage)
+            all_labels = [scipy.cluster.hierarchy.fcluster(dendrogram, threshold, criterion='distance')
+                          for threshold in thresholds]
+        else:
+            raise ValueError("Unknown linkage: '" + self.linkage + "'. Supported values are: " +
+                             str([linkage.value for linkage in Linkage]))
+
+        end_time = time.time()
+        logging.info("Hierarchical clustering time: " + str(round(end_time-start_time, 2)) + " seconds")
+        return {threshold: self.build_cluster_dictionary(labels, tokens)
+                for threshold, labels in zip(thresholds, all_labels)}
+
+    # returns the edges (rows, columns and distances) of a minimum spanning tree of the tokens of a condensed distances
+    # vector, with Prim's algorithm, which only keeps O(N) values besides the vector: the distance from each token to
+    # the tree, and the tree token it is closest to
+    @staticmethod
+    def get_minimum_spanning_tree(distances, size):
+        offsets = np.arange(size, dtype=np.int64) * (2 * size - np.arange(size, dtype=np.int64) - 1) // 2
+        in_tree = np.zeros(size, dtype=bool)
+        closest_distances = np.full(size, np.inf)
+        closest_tokens = np.zeros(size, dtype=np.int64)
+        rows, cols = np.zeros(max(size - 1, 0), dtype=np.int64), np.zeros(max(size - 1, 0), dtype=np.int64)
+        weights = np.zeros(max(size - 1, 0))
+        current = 0
+        for edge in range(size - 1):
+            in_tree[current] = True
+            closest_distances[current] = np.inf
+            # distances from the current token to every other token, from the columns of the condensed rows above it
+            # and from its own condensed row
+            row = np.empty(size)
+            row[:current] = distances[offsets[:current] + current - np.arange(current) - 1]
+            row[current] = np.inf
+            row[current + 1:] = distances[offsets[current]:offsets[current] + size - current - 1]
+            closer = (row < closest_distances) & ~in_tree
+            closest_distances[closer] = row[closer]
+            closest_tokens[closer] = current
+            current = int(np.argmin(closest_distances))
+            rows[edge], cols[edge], weights[edge] = closest_tokens[current], current, closest_distances[current]
+        return rows, cols, weights
+
     def build_cluster_dictionary(self, labels, tokens):
         clusters = dict()
-        key = 0
-        for cluster_id in np.unique(labels):
-            cluster = np.unique(tokens[np.nonzero(labels == cluster_id)])
-            clusters[key] = cluster.tolist()
-            key += 1
+        for key, (cluster_id, cluster) in enumerate(self.group_tokens(labels, tokens)):
+            clusters[key] = cluster
         return clusters
 
     def build_ap_cluster_dictionary(self, labels, tokens, centers_indices):
         clusters = dict()
-        for cluster_id in np.unique(labels):
+        for cluster_id, cluster in self.group_tokens(labels, tokens):
             exemplar = tokens[centers_indices[cluster_id]]
-            cluster = np.unique(tokens[np.nonzero(labels == cluster_id)])
-            clusters[exemplar] = cluster.tolist()
+            clusters[exemplar] = cluster
         return clusters
 
+    # returns the (cluster id, sorted distinct tokens) of each cluster, by increasing cluster id. the tokens are sorted
+    # by cluster id and then by token in a single pass, and every cluster is a contiguous run of the sorted tokens
+    @staticmethod
+    def group_tokens(labels, tokens):
+        labels = np.asarray(labels)
+        order = np.lexsort((tokens, labels))
+        labels, tokens = labels[order], np.asarray(tokens)[order]
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]]) if len(labels) else np.empty(0, dtype=int)
+        ends = np.r_[starts[1:], len(labels)].astype(int)
+        # duplicate tokens are adjacent within their cluster
+        distinct = np.r_[True, (labels[1:] != labels[:-1]) | (tokens[1:] != tokens[:-1])] if len(labels) else []
+        return [(labels[start], tokens[start:end][distinct[start:end]].tolist()) for start, end in zip(starts, ends)]
+
     def cluster(self, tokens, distance_metric, clustering_algorithm, ngrams):
-        tokens = np.array(list(StringNormalize().normalize_tokens(tokens)))
-        distances = StringDistance().get_distances(tokens, distance_metric, ngrams)
+        tokens, weights, members = self.collapse_tokens(*self.count_tokens(tokens, self.workers))
+        distances = self.get_distances(tokens, distance_metric, clustering_algorithm, ngrams)
+        clusters = self.cluster_distances(distances, tokens, distance_metric, clustering_algorithm, weights, members)
+        self.save_distances_matrix(distances, tokens, distance_metric)
+        return clusters
+
+    # clusters the given tokens with every combination of the given distance metrics and clustering algorithms. the
+    # tokens are normalized (and collapsed) once and each distances matrix is computed once, then shared through
+    # shared memory with a pool of worker processes that run the clustering algorithms. returns a dictionary that maps
+    # each pair of (distance metric, clustering algorithm) to its clusters dictionary
+    def cluster_all(self, tokens, distance_metrics, clustering_algorithms, ngrams):
+        tokens, weights, members = self.collapse_tokens(*self.count_tokens(tokens, self.workers))
+        if self.embedding is not None:
+            # embedded tokens take the place of every distance metric, so each algorithm is only run once
+            vectors = self.embedding.get_ngram_vectors(tokens)
+            return {(EMBEDDING, clustering_algorithm): self.cluster_vectors(vectors, tokens, clustering_algorithm,
+                                                                            weights, members)
+                    for clustering_algorithm in clustering_algorithms}
+        if self.sparse or self.approximate:
+            self.check_sparse_algorithms(clustering_algorithms)
+            # sparse and approximate distances are bounded by a different distance for each clustering algorithm
+            all_clusters = dict()
+            for distance_metric in distance_metrics:
+                for clustering_algorithm in clustering_algorithms:
+                    distances = self.get_distances(tokens, distance_metric, clustering_algorithm, ngrams)
+                    all_clusters[(distance_metric, clustering_algorithm)] = self.cluster_distances(
+                        distances, tokens, distance_metric, clustering_algorithm, weights, members)
+                    self.save_distances_matrix(distances, tokens, distance_metric)
+            return all_clusters
+        # dense matrices of all metrics are computed together, in a single pass over the pairs of tokens. hierarchical
+        # clustering alone only needs condensed distances
+        fused_distances = None
+        if any(alg != Algorithm.HIERARCHICAL.value for alg in clustering_algorithms):
+            fused_distances = self.get_string_distance().get_fused_distances(tokens, distance_metrics, ngrams)
+        all_clusters = dict()
+        for distance_metric in distance_metrics:
+            if fused_distances is not None:
+                distances = fused_distances[distance_metric]
+            else:
+                distances = self.get_distances(tokens, distance_metric, clustering_algorithms[0], ngrams)
+            if self.workers > 1 and len(clustering_algorithms) > 1:
+                all_clusters.update(self.cluster_shared_distances(distances, tokens, distance_metric,
+                                                                  clustering_algorithms, weights, members))
+            else:
+                for clustering_algorithm in clustering_algorithms:
+                    all_clusters[(distance_metric, clustering_algorithm)] = self.cluster_distances(
+                        distances, tokens, distance_metric, clustering_algorithm, weights, members)
+            self.save_distances_matrix(distances, tokens, distance_metric)
+        return all_clusters
+
+    # runs each clustering algorithm in a separate worker process. dense matrices are copied once into shared memory
+    # (or, if memory-mapped, reopened from their file) rather than being pickled for every worker
+    def cluster_shared_distances(self, distances, tokens, distance_metric, clustering_algorithms, weights=None,
+                                 members=None):
+        shared_memory = None
+        if scipy.sparse.issparse(distances):
+            shared_distances = ("sparse", distances)
+        elif isinstance(distances, np.memmap):
+            shared_distances = ("file", distances.filename)
+        else:
+            shared_memory = SharedMemory(create=True, size=max(distances.nbytes, 1))
+            np.ndarray(distances.shape, dtype=distances.dtype, buffer=shared_memory.buf)[:] = distances
+            shared_distances = ("shared", shared_memory.name, distances.shape, distances.dtype.str)
+        try:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(clustering_algorithms))) as executor:
+                futures = {clustering_algorithm: executor.submit(cluster_shared_distances, self, shared_distances,
+                                                                 tokens, distance_metric, clustering_algorithm,
+                                                                 weights, members)
+                           for clustering_algorithm in clustering_algorithms}
+                return {(distance_metric, clustering_algorithm): future.result()
+                        for clustering_algorithm, future in futures.items()}
+        finally:
+            if shared_memory is not None:
+                shared_memory.close()
+                shared_memory.unlink()
+
+    # normalizes and deduplicates the tokens as they are read (tokens may be a generator, see StringUtils.read_lines).
+    # returns the distinct normalized tokens, sorted so that the rows of the distances matrix have the same order in
+    # every run, and the number of occurrences of each of them as an array. tokens are normalized over a pool of worker
+    # processes if workers > 1
+    @staticmethod
+    def count_tokens(tokens, workers=1):
+        token_counts = StringNormalize().count_tokens(tokens, workers)
+        sorted_tokens = np.array(sorted(token_counts))
+        counts = np.fromiter((token_counts[token] for token in sorted_tokens), dtype=np.int64, count=len(sorted_tokens))
+        return sorted_tokens, counts
+
+    # collapses the tokens that share a canonical form (their sorted words, or their text without white space, see
+    # Collapse) into the most frequent of them, given their numbers of occurrences. returns the sorted representative
+    # tokens, the number of tokens each of them stands for, and a dictionary that maps each representative to all
+    # the tokens it stands for. tokens are returned as they are, without weights or members, if collapse is not set
+    def collapse_tokens(self, tokens, counts):
+        if self.collapse is None:
+            return tokens, None, None
+        start_time = time.time()
 
+        if self.collapse == Collapse.WORDS.value:
+            keys = np.array([" ".join(sorted(token.split())) for token in tokens], dtype=str)
+        elif self.collapse == Collapse.SPACES.value:
+            keys = np.array(["".join(token.split()) for token in tokens], dtype=str)
+        else:
+            raise ValueError("Unknown collapse: '" + self.collapse + "'. Supported values are: " +
+                             str([collapse.value for collapse in Collapse]))
+        # the tokens are sorted by canonical form, then by decreasing count and then by token, so that every group of
+        # tokens is a contiguous run of the sorted tokens that starts with its representative
+        order = np.lexsort((tokens, -np.asarray(counts), keys))
+        keys, variants = keys[order], np.asarray(tokens, dtype=str)[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.empty(0, dtype=int)
+        ends = np.r_[starts[1:], len(keys)].astype(int)
+        members = {str(variants[start]): sorted(variants[start:end].tolist()) for start, end in zip(starts, ends)}
+        representatives = np.array(sorted(members), dtype=str)
+        weights = np.fromiter((len(members[token]) for token in representatives), dtype=np.int64,
+                              count=len(representatives))
+
+        end_time = time.time()
+        logging.info("Collapsing time: " + str(round(end_time-start_time, 2)) + " seconds (" + str(len(tokens)) +
+                     " tokens into " + str(len(representatives)) + ")")
+        return representatives, weights, members
+
+    # replaces every token of a clusters dictionary with the (sorted) tokens it stands for
+    @staticmethod
+    def expand_clusters(clusters, members):
+        return {key: sorted(member for token in cluster for member in members[token])
+                for key, cluster in clusters.items()}
+
+    # clusters the tokens according to the given distances matrix, and saves the clusters dictionary. if the tokens
+    # were collapsed (see collapse_tokens), DBSCAN weighs each of them by the given weights, and the clusters are
+    # expanded to the members of their tokens
+    def cluster_distances(self, distances, tokens, distance_metric, clustering_algorithm, weights=None,
+                          members=None):
         if clustering_algorithm == Algorithm.AFFINITY_PROPAGATION.value:
             clusters = self.cluster_affinity_propagation(distances, tokens)
         elif clustering_algorithm == Algorithm.DBSCAN.value:
-            clusters = self.cluster_dbscan(distances, tokens, distance_metric)
+            clusters = self.cluster_dbscan(distances, tokens, distance_metric, weights)
         elif clustering_algorithm == Algorithm.HDBSCAN.value:
             clusters = self.cluster_hdbscan(distances, tokens)
         elif clustering_algorithm == Algorithm.MEAN_SHIFT.value:
             clusters = self.cluster_meanshift(distances, tokens)
+        elif clustering_algorithm == Algorithm.HIERARCHICAL.value:
+            clusters = self.cluster_hierarchical(distances, tokens, distance_metric)
         else:
             raise ValueError("Unknown clustering algorithm: '" + clustering_algorithm + "'. Supported values are: " +
                              str([alg.value for alg in Algorithm]))
-
-        logging.info("Saving clusters dictionary...")
-        StringUtils.save_dictionary_as_json(self.output_folder + "clusters_" + clustering_algorithm + "_" +
-                                            distance_metric + ".json", clusters)
-        logging.info("Saving distances matrix...")
-        self.save_distances(self.output_folder + "distances_" + distance_metric + ".csv", distances, tokens)
+        if members is not None and clustering_algorithm == Algorithm.HIERARCHICAL.value:
+            clusters = {threshold: self.expand_clusters(threshold_clusters, members)
+                        for threshold, threshold_clusters in clusters.items()}
+        elif members is not None:
+            clusters = self.expand_clusters(clusters, members)
+
+        output_file = self.output_folder + "clusters_" + clustering_algorithm + "_" + distance_metric
+        if clustering_algorithm == Algorithm.HIERARCHICAL.value:
+            # each cut of the dendrogram is saved as a clusters dictionary of its own, like those of other algorithms
+            for threshold, threshold_clusters in clusters.items():
+                self.save_clusters(output_file + "_" + str(threshold), threshold_clusters)
+        else:
+            self.save_clusters(output_file, clusters)
         return clusters
 
-    def save_distances(self, output_file, distances, tokens):
-        names = [t for t in tokens]
-        df = pd.DataFrame(distances, index=names, columns=names)
-        df.to_csv(output_file, index=True, header=True, sep=',')
-
-
-# Use arparse to get command line arguments
+    # saves a clusters dictionary in the configured format (see ClustersFormat), one cluster at a time. JSON Lines
+    # files have one {"cluster": key, "tokens": [...]} object per line
+    def save_clusters(self, output_file, clusters):
+        logging.info("Saving clusters dictionary...")
+        if self.clusters_format == ClustersFormat.JSON.value:
+            StringUtils.save_dictionary_as_json(output_file + ".json", clusters)
+        elif self.clusters_format == ClustersFormat.COMPACT_JSON.value:
+            StringUtils.save_dictionary_as_compact_json(output_file + ".json", clusters)
+        elif self.clusters_format == ClustersFormat.JSON_LINES.value:
+            StringUtils.save_dictionary_as_json_lines(output_file + ".jsonl", clusters, ["cluster"], "tokens")
+        else:
+            raise ValueError("Unknown clusters format: '" + self.clusters_format + "'. Supported values are: " +
+                             str([clusters_format.value for clusters_format in ClustersFormat]))
+
+    # saves a distances matrix in the configured format: as CSV, as .npy (which StringDistance.load_distances reopens
+    # as a memory map) or compressed .npz, as a sparse .npz of the pairs within the DBSCAN eps of the metric, or not at
+    # all. sparse matrices are always saved as sparse .npz, and condensed distances as .npy. every format but CSV,
+    # whose header lists the tokens, saves the tokens in a separate .tokens file
+    def save_distances_matrix(self, distances, tokens, distance_metric):
+        if self.matrix_format == MatrixFormat.NONE.value:
+            return
+        output_file = self.output_folder + "distances_" + distance_metric
+        if scipy.sparse.issparse(distances) or self.matrix_format == MatrixFormat.SPARSE.value and distances.ndim == 2:
+            logging.info("Saving sparse distances matrix...")
+            if not scipy.sparse.issparse(distances):
+                distances = self.get_thresholded_distances(distances, self.get_eps_dbscan(distance_metric))
+            scipy.sparse.save_npz(output_file + ".npz", distances)
+        # condensed distances are saved as they are, since they are kept condensed to save memory
+        elif distances.ndim == 1:
+            logging.info("Saving condensed distances...")
+            np.save(output_file + "_condensed.npy", distances)
+        elif self.matrix_format == MatrixFormat.NPY.value:
+            # out-of-core matrices are already saved there
+            if not isinstance(distances, np.memmap) or os.path.abspath(distances.filename) != \
+                    os.path.abspath(output_file + ".npy"):
+                logging.info("Saving distances matrix...")
+                np.save(output_file + ".npy", distances)
+        elif self.matrix_format == MatrixFormat.NPZ.value:
+            logging.info("Saving distances matrix...")
+            np.savez_compressed(output_file + ".npz", distances=distances)
+        elif self.matrix_format == MatrixFormat.CSV.value:
+            # out-of-core matrices are already saved as .npy, and are too large to be worth writing as text. cached
+            # matrices are memory-mapped too, but are written like any other
+            if not self.out_of_core:
+                logging.info("Saving distances matrix...")
+                self.save_distances(output_file + ".csv", distances, tokens)
+            return
+        else:
+            raise ValueError("Unknown matrix format: '" + self.matrix_format + "'. Supported values are: " +
+                             str([matrix_format.value for matrix_format in MatrixFormat]))
+        StringUtils.save_list_to_file(output_file + ".tokens", tokens)
+
+    # returns a sparse (CSR) matrix of the distances of at most max_distance of a dense (possibly memory-mapped)
+    # matrix, read a block of rows at a time
+    @staticmethod
+    def get_thresholded_distances(distances, max_distance, block_size=1024):
+        rows, cols, data = [], [], []
+        for i0 in range(0, distances.shape[0], block_size):
+            block = np.asarray(distances[i0:i0+block_size])
+            block_rows, block_cols = np.nonzero(block <= max_distance)
+            off_diagonal = block_rows + i0 != block_cols
+            rows.append(block_rows[off_diagonal] + i0)
+            cols.append(block_cols[off_diagonal])
+            data.append(block[block_rows[off_diagonal], block_cols[off_diagonal]])
+        return scipy.sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                       shape=distances.shape)
+
+    # computes the distances matrix the clustering algorithm will work on: a sparse matrix of the pairs within eps
+    # for DBSCAN (or within max_distance for affinity propagation) in sparse mode, a sparse matrix of approximate
+    # distances for DBSCAN, HDBSCAN and affinity propagation in approximate mode, a condensed vector of distances for
+    # hierarchical clustering, and a dense (possibly memory-mapped) matrix otherwise
+    def get_distances(self, tokens, distance_metric, clustering_algorithm, ngrams):
+        string_distance = self.get_string_distance()
+        if self.approximate:
+            max_distance = self.get_max_distance(distance_metric, clustering_algorithm)
+            return string_distance.get_approximate_distances(tokens, distance_metric, max_distance, ngrams,
+                                                             self.num_perm, self.bands,
+                                                             max_bucket_size=self.max_bucket_size)
+        if not self.sparse and clustering_algorithm == Algorithm.HIERARCHICAL.value:
+            return string_distance.get_condensed_distances(tokens, distance_metric, ngrams)
+        if not self.sparse:
+            return string_distance.get_distances(tokens, distance_metric, ngrams)
+        max_distance = self.get_max_distance(distance_metric, clustering_algorithm)
+        return string_distance.get_sparse_distances(tokens, distance_metric, max_distance, ngrams=ngrams)
+
+    # returns the largest distance kept in the sparse (or approximate) distances of the clustering algorithm: the
+    # DBSCAN eps of the distance metric for DBSCAN, and max_distance for affinity propagation (and for HDBSCAN, which
+    # only gets approximate distances)
+    def get_max_distance(self, distance_metric, clustering_algorithm):
+        self.check_sparse_algorithms([clustering_algorithm])
+        if clustering_algorithm == Algorithm.DBSCAN.value:
+            return int(self.get_eps_dbscan(distance_metric))
+        return self.max_distance
+
+    def check_sparse_algorithms(self, clustering_algorithms):
+        algorithms = [Algorithm.DBSCAN.value, Algorithm.AFFINITY_PROPAGATION.value]
+        if self.approximate:
+            algorithms.append(Algorithm.HDBSCAN.value)
+        unsupported = [alg for alg in clustering_algorithms if alg not in algorithms]
+        if unsupported:
+            raise ValueError(("Approximate" if self.approximate else "Sparse") + " distances are not supported by " +
+                             "the '" + unsupported[0] + "' algorithm. Supported algorithms are: " + str(algorithms))
+
+    def get_string_distance(self):
+        memmap_folder = self.output_folder if self.out_of_core else None
+        return StringDistance(workers=self.workers, memmap_folder=memmap_folder, cache=self.cache, kernel=self.kernel,
+                              update=self.update)
+
+    # writes the distances matrix as CSV, with the tokens as header and as first column, a block of rows at a time,
+    # so that the matrix is never formatted as a whole in memory
+    def save_distances(self, output_file, distances, tokens, block_size=256):
+        with open(output_file, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow([""] + list(tokens))
+            for i0 in range(0, distances.shape[0], block_size):
+                block = np.asarray(distances[i0:i0+block_size])
+                for token, row in zip(tokens[i0:i0+block_size], block.astype(str)):
+                    writer.writerow([token] + row.tolist())
+
+
+# runs one clustering algorithm in a worker process of StringClusters.cluster_all, over a distances matrix shared by
+# the parent process
+def cluster_shared_distances(string_clusters, shared_distances, tokens, distance_metric, clustering_algorithm,
+                             weights=None, members=None):
+    # the worker is already one of the worker processes, so the algorithm must not start a process pool of its own
+    string_clusters.workers = 1
+    shared_memory = None
+    if shared_distances[0] == "shared":
+        shared_memory = SharedMemory(name=shared_distances[1])
+        distances = np.ndarray(shared_distances[2], dtype=shared_distances[3], buffer=shared_memory.buf)
+    elif shared_distances[0] == "file":
+        distances = np.load(shared_distances[1], mmap_mode='r')
+    else:
+        distances = shared_distances[1]
+    try:
+        return string_clusters.cluster_distances(distances, tokens, distance_metric, clustering_algorithm, weights,
+                                                 members)
+    finally:
+        if shared_memory is not None:
+            del distances
+            shared_memory.close()
+
+
+# Use arparse to get command line arguments, as an argparse Namespace
 def get_arguments():
     # get timestamp in ISO format, and replace colons with dashes in timestamp to have a valid file name
     timestamp = datetime.datetime.now().isoformat().replace(":", "-")
@@ -167,20 +853,108 @@ def get_arguments():
         description="StringClusters is a tool to compare strings using different distance metrics, and to cluster them "
                     "using various clustering algorithms according to the pairwise distances between strings.")
     parser.add_argument("-i", "--input_file", required=True, type=str,
-                        help="Input file containing list of strings (one per line)")
+                        help="Input file containing list of strings (one per line), which may be compressed "
+                             "with gzip (.gz), bzip2 (.bz2) or xz (.xz)")
     parser.add_argument("-o", "--output_file", required=False, type=str, default=default_output_file,
                         help="Output file. By default saves as 'stringclusters_output.json' with a creation timestamp, "
                              "to the current directory")
-    parser.add_argument("-d", "--distance_metric", required=False, type=str, default=Distance.LEVENSHTEIN,
-                        help="Distance metric (levenshtein | damerau | jaro | winkler | jaccard). "
+    parser.add_argument("-d", "--distance_metric", required=False, type=str, nargs="+",
+                        default=[Distance.LEVENSHTEIN.value],
+                        help="Distance metric(s) (levenshtein | damerau | jaro | winkler | jaccard | cosine). "
                              "Default: Levenshtein distance ('levenshtein')")
-    parser.add_argument("-c", "--clustering", required=False, type=str, default=Algorithm.AFFINITY_PROPAGATION,
-                        help="Clustering algorithm (ap | ms | dbscan | hbscan). "
-                             "Supported algorithms are: affinity propagation (ap), mean shift (ms), DBSCAN (dbscan),"
-                             "and HDBSCAN (hdbscan). Default: affinity propagation ('ap')")
+    parser.add_argument("-c", "--clustering", required=False, type=str, nargs="+",
+                        default=[Algorithm.AFFINITY_PROPAGATION.value],
+                        help="Clustering algorithm(s) (ap | ms | dbscan | hbscan | hierarchical). "
+                             "Supported algorithms are: affinity propagation (ap), mean shift (ms), DBSCAN (dbscan), "
+                             "HDBSCAN (hdbscan), and hierarchical clustering (hierarchical). Every algorithm is run "
+                             "with every distance metric, and each distances matrix is computed only once. "
+                             "Default: affinity propagation ('ap')")
     parser.add_argument("-n", "--ngrams", required=False, type=int, default=4,
                         help="Number of characters 'n' for n-grams based algorithms, which work by converting strings "
                              "into sets of n-grams (sequences of n characters). Default: 4.")
+    parser.add_argument("-w", "--workers", required=False, type=int, default=1,
+                        help="Number of worker processes used to compute the pairwise distances, and to run "
+                             "the clustering algorithms. Default: 1.")
+    parser.add_argument("-m", "--out_of_core", required=False, action="store_true",
+                        help="Compute the pairwise distances into memory-mapped .npy files in the output folder "
+                             "rather than in memory, for inputs whose distances matrix does not fit in memory. The "
+                             "files are reused by later runs over the same strings.")
+    parser.add_argument("-u", "--update", required=False, action="store_true",
+                        help="With --out_of_core, update the distance matrices left in the output folder by an earlier "
+                             "run over other strings, computing only the distances involving the new strings, and "
+                             "cluster the updated matrices.")
+    parser.add_argument("-s", "--sparse", required=False, action="store_true",
+                        help="Only compute the distances within the DBSCAN eps neighborhood, or within "
+                             "--max_distance for affinity propagation, as a sparse matrix. Supported by DBSCAN and "
+                             "affinity propagation with levenshtein, damerau, jaccard and cosine distances.")
+    parser.add_argument("-k", "--cache_folder", required=False, type=str,
+                        help="Folder where distance matrices are cached, so that runs over the same strings with the "
+                             "same distance metric reuse them instead of recomputing them. Default: no cache.")
+    parser.add_argument("--cache_size", required=False, type=int, default=10240,
+                        help="Maximum size of the distance matrices cache in megabytes. The least recently used "
+                             "matrices are evicted when it is exceeded. Default: 10240.")
+    parser.add_argument("--kernel", required=False, type=str, default=Kernel.JELLYFISH.value,
+                        choices=[kernel.value for kernel in Kernel],
+                        help="Implementation of Levenshtein, Jaro and Jaro-Winkler distances (jellyfish | "
+                             "bitparallel). 'bitparallel' computes whole blocks of distances at a time with "
+                             "bit-parallel algorithms, and gives the same distances as 'jellyfish'. "
+                             "Default: 'jellyfish'.")
+    parser.add_argument("-a", "--approximate", required=False, action="store_true",
+                        help="Approximate the jaccard and cosine distances within the DBSCAN eps neighborhood, or "
+                             "within --max_distance for HDBSCAN and affinity propagation, with MinHash "
+                             "locality-sensitive hashing, as a sparse matrix. Supported by DBSCAN, HDBSCAN and "
+                             "affinity propagation with jaccard and cosine distances. MinHash signatures are computed "
+                             "over the n-grams of the strings (see --ngrams).")
+    parser.add_argument("--permutations", required=False, type=int, default=128,
+                        help="Number of values of the MinHash signatures of approximate distances. Default: 128.")
+    parser.add_argument("--bands", required=False, type=int, default=32,
+                        help="Number of bands the MinHash signatures are split into. More bands find more of the "
+                             "close pairs of strings, at the cost of speed. Must divide --permutations. Default: 32.")
+    parser.add_argument("--max_bucket_size", required=False, type=int, default=1000,
+                        help="Largest number of strings that agree on a band of their MinHash signatures for their "
+                             "pairs to be compared. Larger buckets only share very common n-grams, and are skipped. "
+                             "Larger values find more of the close pairs, at the cost of speed and memory. "
+                             "Default: 1000.")
+    parser.add_argument("--max_distance", required=False, type=int, default=50,
+                        help="Largest approximate distance given to HDBSCAN, where farther pairs of strings are "
+                             "treated as being just beyond it, and largest sparse or approximate distance given to "
+                             "affinity propagation, which only passes messages between the pairs of strings within "
+                             "it. Default: 50.")
+    parser.add_argument("-e", "--embedding", required=False, action="store_true",
+                        help="Cluster the strings with DBSCAN or HDBSCAN as vectors of the TF-IDF weights of their "
+                             "n-grams, reduced with a truncated SVD, instead of computing their pairwise distances. "
+                             "The distance metrics are then ignored.")
+    parser.add_argument("--dimensions", required=False, type=int, default=64,
+                        help="Number of dimensions of the embedded strings. Default: 64.")
+    parser.add_argument("--embedding_eps", required=False, type=float, default=0.5,
+                        help="DBSCAN eps for the embedded strings, which are unit vectors. Default: 0.5.")
+    parser.add_argument("--meanshift_dimensions", required=False, type=int, default=32,
+                        help="Number of dimensions of the embedding of the distances that mean shift clusters, in "
+                             "place of all of the distances between strings. Default: 32.")
+    parser.add_argument("--linkage", required=False, type=str, default=Linkage.SINGLE.value,
+                        help="Linkage of hierarchical clustering (single | average | complete). Default: 'single'.")
+    parser.add_argument("--thresholds", required=False, type=float, nargs="+",
+                        help="Distances at which the hierarchical clustering dendrogram is cut, each giving its own "
+                             "clusters (saved to a file suffixed with the threshold) from a single clustering run. "
+                             "Default: the DBSCAN eps of the distance metric.")
+    parser.add_argument("-f", "--matrix_format", required=False, type=str, default=MatrixFormat.CSV.value,
+                        help="Format of the saved distance matrices (csv | npy | npz | sparse | none). 'npy' and "
+                             "'npz' save binary matrices with the tokens in a separate .tokens file, 'npy' matrices "
+                             "can be reopened as memory maps, 'sparse' only saves the distances within the DBSCAN eps "
+                             "of the distance metric, and 'none' does not save the matrices. Default: 'csv'.")
+    parser.add_argument("--clusters_format", required=False, type=str, default=ClustersFormat.JSON.value,
+                        help="Format of the saved clusters (json | compact | jsonl). 'compact' saves JSON without "
+                             "indentation, and 'jsonl' saves one cluster per line. Default: 'json'.")
+    parser.add_argument("--ap_neighbors", required=False, type=int,
+                        help="Run affinity propagation only over the pairs of each string and its given number of "
+                             "nearest neighbors, so that it takes memory proportional to the number of strings rather "
+                             "than to its square. With --sparse or --approximate, the neighbors are found among the "
+                             "strings within --max_distance, without computing the dense distances matrix. "
+                             "Default: all pairs of strings (within --max_distance with --sparse or --approximate).")
+    parser.add_argument("--collapse", required=False, type=str,
+                        help="Cluster the strings that only differ in word order (words) or in white space (spaces) "
+                             "as a single string, weighted by their number for DBSCAN, and list all of them in its "
+                             "clusters. Default: no collapse.")
     arguments = parser.parse_args()
 
     if not os.path.exists(arguments.input_file):
@@ -191,10 +965,22 @@ def get_arguments():
     if os.path.dirname(arguments.output_file):
         os.makedirs(os.path.dirname(arguments.output_file), exist_ok=True)
 
-    return arguments.input_file, arguments.output_file, arguments.distance_metric, arguments.clustering, arguments.ngrams
+    return arguments
 
 
 if __name__ == "__main__":
     args = get_arguments()
-    strings = StringUtils.parse_file(args[0])
-    StringClusters(args[1]).cluster(strings, args[2], args[3], args[4])
+    # the input file is streamed, so that only its distinct normalized strings are held in memory
+    strings = StringUtils.read_lines(args.input_file)
+    distance_cache = DistanceCache(args.cache_folder, args.cache_size * 1024 * 1024) if args.cache_folder else None
+    string_embedding = StringEmbedding(ngrams=args.ngrams, dimensions=args.dimensions) if args.embedding else None
+    string_clusters = StringClusters(args.output_file, workers=args.workers, out_of_core=args.out_of_core,
+                                     sparse=args.sparse, cache=distance_cache, kernel=args.kernel,
+                                     approximate=args.approximate, num_perm=args.permutations, bands=args.bands,
+                                     max_distance=args.max_distance, ap_neighbors=args.ap_neighbors,
+                                     embedding=string_embedding, embedding_eps=args.embedding_eps,
+                                     meanshift_dimensions=args.meanshift_dimensions, linkage=args.linkage,
+                                     thresholds=args.thresholds, matrix_format=args.matrix_format,
+                                     clusters_format=args.clusters_format, collapse=args.collapse,
+                                     update=args.update, max_bucket_size=args.max_bucket_size)
+    string_clusters.cluster_all(strings, args.distance_metric, args.clustering, args.ngrams)
@@ -2,13 +2,19 @@
 """Provides StringDistance class"""
 
 import logging
+import math
+import os
 import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
 import jellyfish
 import nltk
 import numpy as np
+import scipy.sparse
 from similarity.cosine import Cosine
+from stringutils import StringUtils
 
 __author__ = "Rafael Gonçalves, Stanford University"
 
@@ -22,21 +28,574 @@ class Distance(Enum):
     COSINE = 'cosine'
 
 
+# implementations of the pairwise distance computations
+class Kernel(Enum):
+    JELLYFISH = 'jellyfish'  # one call to jellyfish per pair of tokens
+    # levenshtein (Myers' algorithm), jaro and jaro-winkler distances of whole blocks of tokens at a time
+    BIT_PARALLEL = 'bitparallel'
+
+
+# returns a function that computes the distance between two tokens according to the specified distance metric.
+# all supported metrics are symmetric, so f(w1, w2) == f(w2, w1)
+def get_distance_function(distance_metric, ngrams):
+    if distance_metric == Distance.LEVENSHTEIN.value:
+        return jellyfish.levenshtein_distance
+    elif distance_metric == Distance.DAMERAU_LEVENSHTEIN.value:
+        return jellyfish.damerau_levenshtein_distance
+    # returns a percentage. 0 represents an exact match, 100 represents completely different strings
+    elif distance_metric == Distance.JARO.value:
+        return lambda w1, w2: int(100*(1-jellyfish.jaro_distance(w1, w2)))
+    elif distance_metric == Distance.JARO_WINKLER.value:
+        return lambda w1, w2: int(100*(1-jellyfish.jaro_winkler(w1, w2)))
+    elif distance_metric == Distance.JACCARD.value:
+        return lambda w1, w2: int(100*nltk.jaccard_distance(set(w1), set(w2)))
+    elif distance_metric == Distance.COSINE.value:
+        cos = Cosine(ngrams)
+        return lambda w1, w2: int(100*cos.distance(w1, w2))
+    else:
+        raise ValueError("Unknown distance metric input: '" + distance_metric + "'. Supported values are: " +
+                         str([distance.value for distance in Distance]))
+
+
+# returns the smallest unsigned integer type that can hold every distance between the given tokens. the percentage
+# based metrics are bounded by 100, and the edit distances are bounded by the length of the longest token
+def get_distance_dtype(tokens, distance_metric):
+    if distance_metric == Distance.LEVENSHTEIN.value or distance_metric == Distance.DAMERAU_LEVENSHTEIN.value:
+        return np.min_scalar_type(max([len(token) for token in tokens], default=0))
+    return np.dtype(np.uint8)
+
+
+# returns the Levenshtein distance between two tokens if it is at most max_distance, or max_distance+1 otherwise.
+# only the diagonal band of width 2*max_distance+1 of the dynamic programming table is computed, and the computation
+# stops as soon as every cell of a row exceeds max_distance
+def bounded_levenshtein_distance(w1, w2, max_distance):
+    if len(w1) > len(w2):
+        w1, w2 = w2, w1
+    if len(w2) - len(w1) > max_distance:
+        return max_distance + 1
+    exceeded = max_distance + 1
+    previous = [min(j, exceeded) for j in range(len(w2) + 1)]
+    for i in range(1, len(w1) + 1):
+        low = max(1, i - max_distance)
+        high = min(len(w2), i + max_distance)
+        current = [exceeded] * (len(w2) + 1)
+        if low == 1:
+            current[0] = min(i, exceeded)
+        c1 = w1[i-1]
+        for j in range(low, high + 1):
+            current[j] = min(previous[j-1] + (c1 != w2[j-1]), previous[j] + 1, current[j-1] + 1, exceeded)
+        if min(current[low-1:high+1]) > max_distance:
+            return exceeded
+        previous = current
+    return previous[len(w2)]
+
+
+# returns the multiset of q-grams (substrings of q characters) of a token
+def get_qgram_profile(token, q):
+    return Counter(token[i:i+q] for i in range(len(token) - q + 1))
+
+
+# returns a sparse (CSR) matrix with the counts of each n-gram (substring of n characters, ignoring white space) in
+# each token, as profiled by similarity.cosine.Cosine
+def get_ngram_profiles(tokens, ngrams):
+    vocabulary = dict()
+    rows, cols = [], []
+    for row, token in enumerate(tokens):
+        token = "".join(token.split())
+        for i in range(len(token) - ngrams + 1):
+            rows.append(row)
+            cols.append(vocabulary.setdefault(token[i:i+ngrams], len(vocabulary)))
+    # duplicate (row, column) entries are summed into counts
+    return scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                   shape=(len(tokens), len(vocabulary)))
+
+
+# returns the sorted set of characters used by the given tokens
+def get_alphabet(tokens):
+    return sorted(set().union(*[set(token) for token in tokens]))
+
+
+# returns a 64-bit mask for each token, where bit b is set if the token contains the b-th character of the alphabet of
+# all tokens. requires that the tokens use at most 64 distinct characters
+def get_character_masks(tokens):
+    bits = {character: np.uint64(1) << np.uint64(bit) for bit, character in enumerate(get_alphabet(tokens))}
+    masks = np.zeros(len(tokens), dtype=np.uint64)
+    for i, token in enumerate(tokens):
+        for character in set(token):
+            masks[i] |= bits[character]
+    return masks
+
+
+# returns the number of set bits of each element of an array of unsigned 64-bit integers
+def popcount(array):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(array)
+    # numpy < 2.0: sum the set bits of each of the 8 bytes of every element
+    byte_counts = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+    return byte_counts[array[..., np.newaxis].view(np.uint8)].sum(axis=-1, dtype=np.uint8)
+
+
+# maps each token to an array of alphabet indices, padded with len(alphabet) to the length of the longest token.
+# returns the padded codes and the length of each token
+def encode_tokens(tokens, alphabet):
+    lengths = np.array([len(token) for token in tokens], dtype=np.int64)
+    codes = np.full((len(tokens), max(lengths, default=0)), len(alphabet), dtype=np.int64)
+    for i, token in enumerate(tokens):
+        codes[i, :len(token)] = [alphabet[character] for character in token]
+    return codes, lengths
+
+
+# returns, for each token encoded by encode_tokens, a 64-bit mask per alphabet index with the bits of the positions
+# where that character occurs in the token. the padding index has no positions
+def get_position_masks(codes, lengths, alphabet_size):
+    masks = np.zeros((len(lengths), alphabet_size + 1), dtype=np.uint64)
+    for k in range(codes.shape[1]):
+        texts = np.nonzero(k < lengths)[0]
+        masks[texts, codes[texts, k]] |= np.uint64(1) << np.uint64(k)
+    return masks
+
+
+# computes the levenshtein distances between every pattern (of at most 64 characters) and every text, as encoded by
+# encode_tokens, with the bit-parallel algorithm of Myers (1999), in the formulation of Hyyrö (2001). the bit vectors
+# of all (pattern, text) pairs are updated together, one text position at a time
+def bit_parallel_levenshtein_distances(pattern_codes, pattern_lengths, text_codes, text_lengths, alphabet_size):
+    one = np.uint64(1)
+    # peq[p, a] has bit k set if the k-th character of pattern p is the a-th character of the alphabet
+    peq = get_position_masks(pattern_codes, pattern_lengths, alphabet_size)
+    last_bit = (one << (np.maximum(pattern_lengths, 1) - 1).astype(np.uint64))[:, np.newaxis]
+    shape = (len(pattern_lengths), len(text_lengths))
+    pv = np.full(shape, ~np.uint64(0), dtype=np.uint64)
+    mv = np.zeros(shape, dtype=np.uint64)
+    scores = np.repeat(pattern_lengths[:, np.newaxis], len(text_lengths), axis=1)
+    for t in range(text_codes.shape[1]):
+        active = (t < text_lengths)[np.newaxis, :]
+        eq = peq[:, text_codes[:, t]]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        scores += active & ((ph & last_bit) != 0)
+        scores -= active & ((mh & last_bit) != 0)
+        ph = (ph << one) | one
+        mh = mh << one
+        pv = mh | ~(xv | ph)
+        mv = ph & xv
+    # the distance between an empty pattern and a text is the length of the text
+    scores[pattern_lengths == 0, :] = text_lengths
+    return scores
+
+
+# returns masks with the lowest n bits set, for 0 <= n <= 64
+def get_low_bits(n):
+    with np.errstate(over='ignore'):
+        return np.where(n >= 64, ~np.uint64(0), (np.uint64(1) << n.astype(np.uint64)) - np.uint64(1))
+
+
+# computes the jaro (or, if winklerize is set, jaro-winkler) similarities between every pattern and every text (of at
+# most 64 characters each), as encoded by encode_tokens, exactly as jellyfish does. the characters matched so far in
+# every (pattern, text) pair are kept as bit masks, so each pattern position is matched against all texts at once:
+# the match of a pattern character is the lowest unmatched position of that character in the text's search window
+def bit_parallel_jaro_similarities(pattern_codes, pattern_lengths, text_codes, text_lengths, alphabet_size,
+                                   winklerize=False):
+    one = np.uint64(1)
+    # text_masks[a, t] has the bits of the positions of the a-th character of the alphabet in text t
+    text_masks = np.ascontiguousarray(get_position_masks(text_codes, text_lengths, alphabet_size).T)
+    pattern_lengths = pattern_lengths[:, np.newaxis]
+    text_lengths = text_lengths[np.newaxis, :]
+    search_range = np.maximum(np.maximum(pattern_lengths, text_lengths) // 2 - 1, 0)
+    shape = (pattern_lengths.shape[0], text_lengths.shape[1])
+    pattern_flags = np.zeros(shape, dtype=np.uint64)
+    text_flags = np.zeros(shape, dtype=np.uint64)
+    for i in range(pattern_codes.shape[1]):
+        low = np.maximum(i - search_range, 0)
+        high = np.minimum(i + search_range, text_lengths - 1)
+        window = get_low_bits(high + 1) & ~get_low_bits(low)
+        candidates = text_masks[pattern_codes[:, i]] & window & ~text_flags
+        match = candidates & (~candidates + one)  # lowest set bit
+        text_flags |= match
+        pattern_flags |= np.where(match != 0, one << np.uint64(i), np.uint64(0))
+    # walk the matched characters of both strings in order, and count those that differ
+    transpositions = np.zeros(shape, dtype=np.int64)
+    unvisited = text_flags.copy()
+    for i in range(pattern_codes.shape[1]):
+        matched = ((pattern_flags >> np.uint64(i)) & one) != 0
+        position = unvisited & (~unvisited + one)
+        transpositions += matched & ((text_masks[pattern_codes[:, i]] & position) == 0)
+        unvisited = np.where(matched, unvisited ^ position, unvisited)
+    transpositions //= 2
+    matches = popcount(pattern_flags).astype(np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = (matches / pattern_lengths + matches / text_lengths + (matches - transpositions) / matches) / 3
+    weights[matches == 0] = 0.0
+    if winklerize:
+        # boost by the length of the common prefix, of up to 4 characters
+        prefix_bound = np.minimum(np.minimum(pattern_lengths, text_lengths), 4)
+        prefixes = np.zeros(shape, dtype=np.int64)
+        in_prefix = np.ones(shape, dtype=bool)
+        for k in range(min(4, pattern_codes.shape[1], text_codes.shape[1])):
+            in_prefix &= (k < prefix_bound) & (pattern_codes[:, k, np.newaxis] == text_codes[np.newaxis, :, k])
+            prefixes += in_prefix
+        weights = np.where((weights > 0.7) & (prefixes > 0), weights + prefixes * 0.1 * (1.0 - weights), weights)
+    return weights
+
+
+# returns a function that computes the quantized distances between blocks of encoded tokens with the bit-parallel
+# kernel, or None if the kernel does not implement the specified distance metric
+def get_bit_parallel_function(distance_metric):
+    if distance_metric == Distance.LEVENSHTEIN.value:
+        return bit_parallel_levenshtein_distances
+    elif distance_metric == Distance.JARO.value:
+        return lambda *encoded: np.trunc(100*(1-bit_parallel_jaro_similarities(*encoded)))
+    elif distance_metric == Distance.JARO_WINKLER.value:
+        return lambda *encoded: np.trunc(100*(1-bit_parallel_jaro_similarities(*encoded, winklerize=True)))
+    return None
+
+
+# returns the block function of the given kernel for the specified distance metric (see get_bit_parallel_function),
+# or None if the metric is computed pair by pair
+def get_kernel_function(distance_metric, kernel):
+    if kernel == Kernel.BIT_PARALLEL.value:
+        return get_bit_parallel_function(distance_metric)
+    elif kernel == Kernel.JELLYFISH.value:
+        return None
+    else:
+        raise ValueError("Unknown kernel: '" + kernel + "'. Supported values are: " + str([k.value for k in Kernel]))
+
+
+# returns the features from which cosine distances are computed: the sparse n-gram profile of every token, the norm
+# of every profile, and whether every token has no profile (and thus no similarity with any other token)
+def get_cosine_features(tokens, ngrams):
+    profiles = get_ngram_profiles(tokens, ngrams)
+    norms = np.sqrt(np.asarray(profiles.multiply(profiles).sum(axis=1), dtype=np.float64).ravel())
+    # Cosine considers strings shorter than n to have no similarity with any other string
+    no_profile = (np.array([len(token) for token in tokens], dtype=np.int64) < ngrams) | (norms == 0)
+    return profiles, norms, no_profile
+
+
+# computes the block of cosine distances between tokens[i0:i1] (rows) and tokens[j0:j1] (columns) as a single sparse
+# matrix product. dot products and squared norms are integer-valued, so the similarities, and their quantization, are
+# the same as those of similarity.cosine.Cosine
+def compute_cosine_block(cosine_features, tile, dtype):
+    i0, i1, j0, j1 = tile
+    profiles, norms, no_profile = cosine_features
+    dots = (profiles[i0:i1] @ profiles[j0:j1].T).toarray()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarities = dots / (norms[i0:i1, np.newaxis] * norms[np.newaxis, j0:j1])
+    similarities[no_profile[i0:i1], :] = 0.0
+    similarities[:, no_profile[j0:j1]] = 0.0
+    similarities[np.arange(i0, i1)[:, np.newaxis] == np.arange(j0, j1)[np.newaxis, :]] = 1.0
+    return np.trunc(100*(1.0 - similarities)).astype(dtype)
+
+
+# computes the block of jaccard distances between tokens[i0:i1] (rows) and tokens[j0:j1] (columns) from the
+# popcounts of the intersections and unions of their character masks, which are quantized exactly like
+# int(100*nltk.jaccard_distance(set(w1), set(w2)))
+def compute_jaccard_block(masks, tile, dtype):
+    i0, i1, j0, j1 = tile
+    intersections = popcount(masks[i0:i1, np.newaxis] & masks[np.newaxis, j0:j1]).astype(np.float64)
+    unions = popcount(masks[i0:i1, np.newaxis] | masks[np.newaxis, j0:j1]).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        block = np.trunc(100*((unions - intersections) / unions))
+    # two empty strings have no characters, and are considered identical
+    block[unions == 0] = 0
+    return block.astype(dtype)
+
+
+# returns a sparse (CSR) binary matrix that marks the characters used by each token, the sets jaccard distances compare
+def get_character_sets(tokens):
+    alphabet = {character: i for i, character in enumerate(get_alphabet(tokens))}
+    rows, cols = [], []
+    for row, token in enumerate(tokens):
+        for character in set(token):
+            rows.append(row)
+            cols.append(alphabet[character])
+    return scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                                   shape=(len(tokens), len(alphabet)))
+
+
+# prime modulus of the universal hash functions of MinHash signatures
+MINHASH_PRIME = (1 << 31) - 1
+
+
+# computes a MinHash signature of num_perm values for each row of a sparse (CSR) matrix of shingles, using the
+# universal hash functions (a*x + b) mod p of the shingle columns x. two rows agree on each value of their signatures
+# with a probability equal to the jaccard similarity of their sets of shingles. rows without shingles are left at p
+def get_minhash_signatures(shingles, num_perm, seed=0):
+    random = np.random.RandomState(seed)
+    a = random.randint(1, MINHASH_PRIME, size=num_perm).astype(np.uint64)
+    b = random.randint(0, MINHASH_PRIME, size=num_perm).astype(np.uint64)
+    signatures = np.full((shingles.shape[0], num_perm), MINHASH_PRIME, dtype=np.uint32)
+    nonempty = np.flatnonzero(np.diff(shingles.indptr))
+    if len(nonempty) == 0:
+        return signatures
+    x = shingles.indices.astype(np.uint64)
+    # a few hash functions at a time, so that the hashes of all shingles take a bounded amount of memory
+    for p0 in range(0, num_perm, 16):
+        p1 = min(p0 + 16, num_perm)
+        hashes = (a[p0:p1, np.newaxis] * x[np.newaxis, :] + b[p0:p1, np.newaxis]) % np.uint64(MINHASH_PRIME)
+        signatures[nonempty, p0:p1] = np.minimum.reduceat(hashes, shingles.indptr[nonempty], axis=1).T
+    return signatures
+
+
+# splits the MinHash signatures of the given tokens into bands of rows, and returns the pairs (i < j) of tokens whose
+# signatures agree on every row of at least one band. with b bands of r rows, a pair of tokens with jaccard
+# similarity s is a candidate with probability 1 - (1 - s^r)^b. buckets of more than max_bucket_size tokens are
+# skipped, since their tokens only share shingles so common that the band tells nothing about them, and their pairs
+# alone would outnumber every other candidate
+def get_lsh_candidate_pairs(signatures, bands, tokens, max_bucket_size=1000):
+    size = signatures.shape[0]
+    rows = signatures.shape[1] // bands
+    keys = np.empty(0, dtype=np.int64)
+    for band in range(bands):
+        _, buckets = np.unique(signatures[tokens, band*rows:(band+1)*rows], axis=0, return_inverse=True)
+        buckets = buckets.ravel()
+        order = np.argsort(buckets, kind='stable')
+        starts = np.flatnonzero(np.r_[True, buckets[order][1:] != buckets[order][:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        within = (ends - starts > 1) & (ends - starts <= max_bucket_size)
+        band_keys = [np.empty(0, dtype=np.int64)]
+        for start, end in zip(starts[within], ends[within]):
+            # the stable sort keeps the members of each bucket in increasing order
+            members = tokens[order[start:end]].astype(np.int64)
+            i, j = np.triu_indices(end - start, 1)
+            band_keys.append(members[i] * size + members[j])
+        # pairs found in several bands are merged band by band, so that only the distinct pairs found so far and
+        # those of a single band are held in memory at once
+        keys = np.concatenate([keys] + band_keys)
+        keys.sort(kind='stable')
+        keys = keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+    return keys // size, keys % size
+
+
+# computes the distances between the pairs of tokens (tokens[rows[k]], tokens[cols[k]]), with the same values as the
+# corresponding entries of the dense distances matrix. jaccard and cosine distances are computed all at once from
+# character masks and n-gram profiles, and the other metrics pair by pair
+def compute_pair_distances(tokens, distance_metric, ngrams, rows, cols):
+    if distance_metric == Distance.JACCARD.value and len(get_alphabet(tokens)) <= 64:
+        masks = get_character_masks(tokens)
+        intersections = popcount(masks[rows] & masks[cols]).astype(np.float64)
+        unions = popcount(masks[rows] | masks[cols]).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.trunc(100*((unions - intersections) / unions))
+        distances[unions == 0] = 0
+    elif distance_metric == Distance.COSINE.value:
+        profiles, norms, no_profile = get_cosine_features(tokens, ngrams)
+        dots = np.asarray(profiles[rows].multiply(profiles[cols]).sum(axis=1), dtype=np.float64).ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarities = dots / (norms[rows] * norms[cols])
+        similarities[no_profile[rows] | no_profile[cols]] = 0.0
+        similarities[rows == cols] = 1.0
+        distances = np.trunc(100*(1.0 - similarities))
+    else:
+        function = get_distance_function(distance_metric, ngrams)
+        distances = np.array([function(tokens[i], tokens[j]) for i, j in zip(rows, cols)], dtype=np.float64)
+    return distances.astype(get_distance_dtype(tokens, distance_metric))
+
+
+# returns the pairs (i < j) of rows of a sparse (CSR) matrix of features that share a feature of their prefixes, with
+# the features of each row ordered from the rarest to the most frequent. if weighted, rows are count vectors, and the
+# prefix of a row is its shortest leading part whose remaining features have a norm below threshold times the norm of
+# the row: two rows with a cosine similarity of at least threshold must share a prefix feature. otherwise rows are
+# sets, the prefix of a set x is its first |x| - ceil(threshold*|x|) + 1 features, and pairs are further pruned with
+# the length and positional filters of PPJoin for a jaccard similarity of at least threshold
+def get_prefix_join_pairs(features, threshold, weighted):
+    ranks = np.empty(features.shape[1], dtype=np.int64)
+    ranks[np.argsort(np.bincount(features.indices, minlength=features.shape[1]), kind='stable')] = \
+        np.arange(features.shape[1])
+    sizes = np.diff(features.indptr)
+    index = dict()  # feature rank -> list of (row, position of the feature in the row)
+    rows, cols = [], []
+    # rows are visited by increasing size, so that the rows already indexed are never larger than the current one
+    for x in np.argsort(sizes, kind='stable'):
+        size = sizes[x]
+        if size == 0:
+            continue
+        order = np.argsort(ranks[features.indices[features.indptr[x]:features.indptr[x+1]]], kind='stable')
+        x_features = ranks[features.indices[features.indptr[x]:features.indptr[x+1]]][order]
+        if weighted:
+            weights = features.data[features.indptr[x]:features.indptr[x+1]][order].astype(np.float64)
+            # norms of the features from each position to the end of the row, relative to the norm of the row
+            suffix_norms = np.sqrt(np.cumsum((weights**2)[::-1])[::-1] / np.sum(weights**2))
+            prefix_length = max(int(np.count_nonzero(suffix_norms >= threshold)), 1)
+        else:
+            prefix_length = min(max(size - int(math.ceil(threshold * size)) + 1, 1), size)
+        overlaps = dict()  # row -> number of prefix features shared with x so far, or -1 if the row was pruned
+        for i in range(prefix_length):
+            for y, j in index.get(x_features[i], ()):
+                overlap = overlaps.get(y, 0)
+                if overlap < 0:
+                    continue
+                if not weighted:
+                    y_size = sizes[y]
+                    # a jaccard similarity of at least threshold takes an overlap of at least min_overlap, out of at
+                    # most the features shared so far, this one, and the fewest features left in either set
+                    min_overlap = math.ceil(threshold / (1.0 + threshold) * (size + y_size))
+                    if y_size < threshold * size or overlap + 1 + min(size - i - 1, y_size - j - 1) < min_overlap:
+                        overlaps[y] = -1
+                        continue
+                overlaps[y] = overlap + 1
+        for y, overlap in overlaps.items():
+            if overlap > 0:
+                rows.append(min(x, y))
+                cols.append(max(x, y))
+        for i in range(prefix_length):
+            index.setdefault(x_features[i], []).append((x, i))
+    return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+
+
+# state of a tile worker process, set once per process by init_tile_worker (or init_fused_worker) so that tiles only
+# carry their bounds
+_worker_tokens = None
+_worker_function = None
+_worker_dtype = None
+_worker_block_function = None
+_worker_alphabet = None
+_worker_metrics = None
+_worker_dtypes = None
+_worker_features = None
+
+
+def init_tile_worker(tokens, distance_metric, ngrams, dtype, kernel=Kernel.JELLYFISH.value):
+    global _worker_tokens, _worker_function, _worker_dtype, _worker_block_function, _worker_alphabet
+    _worker_tokens = tokens
+    _worker_function = get_distance_function(distance_metric, ngrams)
+    _worker_dtype = dtype
+    _worker_block_function = get_kernel_function(distance_metric, kernel)
+    if _worker_block_function is not None:
+        _worker_alphabet = {character: code for code, character in enumerate(get_alphabet(tokens))}
+
+
+# computes the block of distances between tokens[i0:i1] (rows) and tokens[j0:j1] (columns)
+def compute_tile(tile):
+    if _worker_block_function is not None:
+        return tile, compute_bit_parallel_block(tile, encode_tile(tile), _worker_block_function, _worker_function,
+                                                _worker_dtype)
+    return tile, compute_pairwise_blocks(tile, [_worker_function], [_worker_dtype])[0]
+
+
+# computes the blocks of distances between tokens[i0:i1] (rows) and tokens[j0:j1] (columns) according to each of the
+# given pair functions, in a single pass over the pairs of tokens. tiles on the diagonal only compute their upper
+# triangle, and mirror it into the lower triangle
+def compute_pairwise_blocks(tile, functions, dtypes):
+    i0, i1, j0, j1 = tile
+    blocks = [np.empty((i1-i0, j1-j0), dtype=dtype) for dtype in dtypes]
+    for i in range(i0, i1):
+        w1 = _worker_tokens[i]
+        start = max(i, j0)
+        if start < j1:
+            values = np.array([[function(w1, w2) for function in functions] for w2 in _worker_tokens[start:j1]])
+            for k, block in enumerate(blocks):
+                block[i-i0, start-j0:] = values[:, k]
+    if i0 == j0:
+        lower = np.tril_indices(i1-i0, -1)
+        for block in blocks:
+            block[lower] = block.T[lower]
+    return blocks
+
+
+# encodes the tokens of a tile for the bit-parallel kernel. tokens longer than 64 characters do not fit in a machine
+# word, so only the rows and columns of shorter tokens are encoded
+def encode_tile(tile):
+    i0, i1, j0, j1 = tile
+    rows = np.array([i for i in range(i0, i1) if len(_worker_tokens[i]) <= 64], dtype=np.intp)
+    cols = np.array([j for j in range(j0, j1) if len(_worker_tokens[j]) <= 64], dtype=np.intp)
+    return rows, cols, encode_tokens([_worker_tokens[i] for i in rows], _worker_alphabet), \
+        encode_tokens([_worker_tokens[j] for j in cols], _worker_alphabet)
+
+
+# computes the block of distances between tokens[i0:i1] (rows) and tokens[j0:j1] (columns) with the bit-parallel
+# kernel, and those involving tokens longer than 64 characters pair by pair
+def compute_bit_parallel_block(tile, encoded_tile, block_function, function, dtype):
+    i0, i1, j0, j1 = tile
+    rows, cols, (pattern_codes, pattern_lengths), (text_codes, text_lengths) = encoded_tile
+    block = np.empty((i1-i0, j1-j0), dtype=dtype)
+    block[np.ix_(rows - i0, cols - j0)] = block_function(pattern_codes, pattern_lengths, text_codes, text_lengths,
+                                                         len(_worker_alphabet))
+    for i in range(i0, i1):
+        if len(_worker_tokens[i]) > 64:
+            block[i-i0] = [function(_worker_tokens[i], _worker_tokens[j]) for j in range(j0, j1)]
+    for j in range(j0, j1):
+        if len(_worker_tokens[j]) > 64:
+            block[:, j-j0] = [function(_worker_tokens[i], _worker_tokens[j]) for i in range(i0, i1)]
+    return block
+
+
+# prepares a worker process to compute the tiles of several distance matrices at once. the per-token features of
+# every metric (character masks, n-gram profiles, alphabet) are derived once for all metrics and tiles
+def init_fused_worker(tokens, distance_metrics, ngrams, dtypes, kernel=Kernel.JELLYFISH.value):
+    global _worker_tokens, _worker_metrics, _worker_dtypes, _worker_features, _worker_alphabet
+    _worker_tokens = tokens
+    _worker_metrics = distance_metrics
+    _worker_dtypes = dtypes
+    _worker_features = dict()
+    _worker_alphabet = {character: code for code, character in enumerate(get_alphabet(tokens))}
+    for distance_metric in distance_metrics:
+        block_function = get_kernel_function(distance_metric, kernel)
+        if distance_metric == Distance.COSINE.value:
+            _worker_features[distance_metric] = get_cosine_features(tokens, ngrams)
+        elif distance_metric == Distance.JACCARD.value and len(_worker_alphabet) <= 64:
+            _worker_features[distance_metric] = get_character_masks(tokens)
+        elif block_function is not None:
+            _worker_features[distance_metric] = (block_function, get_distance_function(distance_metric, ngrams))
+        else:
+            _worker_features[distance_metric] = get_distance_function(distance_metric, ngrams)
+
+
+# computes the blocks of distances between tokens[i0:i1] (rows) and tokens[j0:j1] (columns) of every metric of the
+# worker. the metrics computed pair by pair share a single pass over the pairs of the tile, and the metrics of the
+# bit-parallel kernel share a single encoding of its tokens
+def compute_fused_tile(tile):
+    blocks = dict()
+    encoded_tile = None
+    pairwise_metrics = []
+    for distance_metric in _worker_metrics:
+        features = _worker_features[distance_metric]
+        dtype = _worker_dtypes[distance_metric]
+        if distance_metric == Distance.COSINE.value:
+            blocks[distance_metric] = compute_cosine_block(features, tile, dtype)
+        elif isinstance(features, np.ndarray):
+            blocks[distance_metric] = compute_jaccard_block(features, tile, dtype)
+        elif isinstance(features, tuple):
+            encoded_tile = encoded_tile or encode_tile(tile)
+            blocks[distance_metric] = compute_bit_parallel_block(tile, encoded_tile, *features, dtype)
+        else:
+            pairwise_metrics.append(distance_metric)
+    pairwise_blocks = compute_pairwise_blocks(tile, [_worker_features[metric] for metric in pairwise_metrics],
+                                              [_worker_dtypes[metric] for metric in pairwise_metrics])
+    blocks.update(zip(pairwise_metrics, pairwise_blocks))
+    return tile, blocks
+
+
 class StringDistance:
 
-    def __init__(self):
+    # workers is the number of processes used to compute distance matrices, and tile_size is the number of rows
+    # (and columns) of each square block of the matrix handed to a worker. if memmap_folder is given, matrices are
+    # computed out-of-core into memory-mapped .npy files in that folder, which are reused by later runs over the same
+    # tokens. if update is also set, a matrix of the memmap folder computed for other tokens is updated to the new
+    # tokens (see update_distances) rather than computed anew. if a DistanceCache is given, matrices are looked up in
+    # it before being computed, and added to it after. kernel selects the implementation of levenshtein, jaro and
+    # jaro-winkler distances (see Kernel)
+    def __init__(self, workers=1, tile_size=256, memmap_folder=None, cache=None, kernel=Kernel.JELLYFISH.value,
+                 update=False):
+        self.workers = workers
+        self.tile_size = tile_size
+        self.memmap_folder = memmap_folder
+        self.cache = cache
+        self.kernel = kernel
+        self.update = update
+        get_kernel_function(Distance.LEVENSHTEIN.value, kernel)  # fails on unknown kernels
         logging.basicConfig(level=logging.INFO)
 
     def get_levenshtein_distances(self, tokens):
         start_time = time.time()
-        distances = np.array([[jellyfish.levenshtein_distance(w1, w2) for w1 in tokens] for w2 in tokens])
+        distances = self.compute_distances(tokens, Distance.LEVENSHTEIN.value)
         end_time = time.time()
         logging.info("Levenshtein distances computation time: " + str(round(end_time-start_time, 2)) + " seconds")
         return distances
 
     def get_damerau_levenshtein_distances(self, tokens):
         start_time = time.time()
-        distances = np.array([[jellyfish.damerau_levenshtein_distance(w1, w2) for w1 in tokens] for w2 in tokens])
+        distances = self.compute_distances(tokens, Distance.DAMERAU_LEVENSHTEIN.value)
         end_time = time.time()
         logging.info("Damerau-Levenshtein distances computation time: " + str(round(end_time-start_time, 2)) + " seconds")
         return distances
@@ -44,7 +603,7 @@ class StringDistance:
     # returns a percentage. 0 represents completely different strings, 1 represents an exact match
     def get_jaro_distances(self, tokens):
         start_time = time.time()
-        distances = np.array([[int(100*(1-jellyfish.jaro_distance(w1, w2))) for w1 in tokens] for w2 in tokens])
+        distances = self.compute_distances(tokens, Distance.JARO.value)
         end_time = time.time()
         logging.info("Jaro distances computation time: " + str(round(end_time-start_time, 2)) + " seconds")
         return distances
@@ -52,26 +611,290 @@ class StringDistance:
     # returns a percentage. 0 represents completely different strings, 1 represents an exact match
     def get_jaro_winkler_distances(self, tokens):
         start_time = time.time()
-        distances = np.array([[int(100*(1-jellyfish.jaro_winkler(w1, w2))) for w1 in tokens] for w2 in tokens])
+        distances = self.compute_distances(tokens, Distance.JARO_WINKLER.value)
         end_time = time.time()
         logging.info("Jaro-Winkler distances computation time: " + str(round(end_time-start_time, 2)) + " seconds")
         return distances
 
     def get_jaccard_distances(self, tokens):
         start_time = time.time()
-        distances = np.array([[int(100*nltk.jaccard_distance(set(w1), set(w2))) for w1 in tokens] for w2 in tokens])
+        distances = self.compute_distances(tokens, Distance.JACCARD.value)
         end_time = time.time()
         logging.info("Jaccard distances computation time: " + str(round(end_time-start_time, 2)) + " seconds")
         return distances
 
     def get_cosine_distances(self, tokens, ngrams):
         start_time = time.time()
-        cos = Cosine(ngrams)
-        distances = np.array([[int(100*cos.distance(w1, w2)) for w1 in tokens] for w2 in tokens])
+        distances = self.compute_distances(tokens, Distance.COSINE.value, ngrams)
         end_time = time.time()
         logging.info("Cosine distances computation time: " + str(round(end_time-start_time, 2)) + " seconds")
         return distances
 
+    # splits the upper triangle of the NxN distance matrix into square tiles. if start is given, only the columns
+    # from start onwards are covered: the rows before start are split into rectangular tiles against those columns
+    def get_tiles(self, size, start=0):
+        tiles = []
+        for i0 in range(0, start, self.tile_size):
+            i1 = min(i0 + self.tile_size, start)
+            for j0 in range(start, size, self.tile_size):
+                tiles.append((i0, i1, j0, min(j0 + self.tile_size, size)))
+        for i0 in range(start, size, self.tile_size):
+            i1 = min(i0 + self.tile_size, size)
+            for j0 in range(i0, size, self.tile_size):
+                tiles.append((i0, i1, j0, min(j0 + self.tile_size, size)))
+        return tiles
+
+    # computes the pairwise distance matrix into a preallocated matrix of the smallest integer type that fits the
+    # metric. cosine distances are computed from sparse n-gram profiles, jaccard distances from character bitmasks
+    # (when the tokens use at most 64 distinct characters), and all other metrics pair by pair
+    def compute_distances(self, tokens, distance_metric, ngrams=None):
+        tokens = list(tokens)
+        distances = self.load_computed_distances(tokens, distance_metric, ngrams)
+        if distances is not None:
+            return distances
+        distances = self.allocate_distances(tokens, distance_metric, ngrams)
+        if distance_metric == Distance.COSINE.value:
+            self.fill_cosine_distances(distances, tokens, ngrams)
+        elif distance_metric == Distance.JACCARD.value and len(get_alphabet(tokens)) <= 64:
+            self.fill_jaccard_distances(distances, tokens)
+        else:
+            self.fill_tile_distances(distances, tokens, distance_metric, ngrams)
+        return self.save_computed_distances(distances, tokens, distance_metric, ngrams)
+
+    # returns the previously computed distances matrix of the tokens from the cache or, in out-of-core mode, from the
+    # memmap folder. returns None if there is no such matrix
+    def load_computed_distances(self, tokens, distance_metric, ngrams):
+        distances = None
+        if self.cache is not None:
+            distances = self.cache.load(tokens, distance_metric, ngrams)
+        if distances is None and self.memmap_folder is not None:
+            distances = self.load_memmap_distances(tokens, distance_metric, ngrams)
+        if distances is None and self.memmap_folder is not None and self.update:
+            distances = self.update_memmap_distances(tokens, distance_metric, ngrams)
+        return distances
+
+    # finalizes a newly computed distances matrix (see finalize_distances), and adds it to the cache
+    def save_computed_distances(self, distances, tokens, distance_metric, ngrams):
+        distances = self.finalize_distances(distances, tokens, distance_metric, ngrams)
+        if self.cache is not None:
+            self.cache.store(tokens, distance_metric, ngrams, distances)
+        return distances
+
+    # evaluates only the tiles in the upper triangle of the matrix, possibly over a pool of worker processes, and
+    # writes each tile (and its mirror image) into the distances matrix. if start is given, only the distances
+    # involving the tokens from start onwards are computed. if positions are given, tiles are written to the positions
+    # of their tokens in the matrix (see write_tiles)
+    def fill_tile_distances(self, distances, tokens, distance_metric, ngrams, start=0, positions=None):
+        tiles = self.get_tiles(len(tokens), start)
+        dtype = distances.dtype
+        if self.workers > 1 and len(tiles) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_tile_worker,
+                                     initargs=(tokens, distance_metric, ngrams, dtype, self.kernel)) as executor:
+                self.write_tiles(distances, executor.map(compute_tile, tiles), positions)
+        else:
+            init_tile_worker(tokens, distance_metric, ngrams, dtype, self.kernel)
+            self.write_tiles(distances, map(compute_tile, tiles), positions)
+
+    # encodes the character set of every token once into a 64-bit mask, and computes the jaccard distances of each
+    # block of rows with the rows below it from the popcounts of the intersections and unions of their masks
+    def fill_jaccard_distances(self, distances, tokens):
+        masks = get_character_masks(tokens)
+        for i0 in range(0, len(tokens), self.tile_size):
+            i1 = min(i0 + self.tile_size, len(tokens))
+            block = compute_jaccard_block(masks, (i0, i1, i0, len(tokens)), distances.dtype)
+            distances[i0:i1, i0:] = block
+            distances[i0:, i0:i1] = block.T
+
+    # profiles every token once into a sparse matrix of n-gram counts, and computes the cosine similarities of each
+    # block of rows with the rows below it as a single sparse matrix product
+    def fill_cosine_distances(self, distances, tokens, ngrams):
+        cosine_features = get_cosine_features(tokens, ngrams)
+        for i0 in range(0, len(tokens), self.tile_size):
+            i1 = min(i0 + self.tile_size, len(tokens))
+            block = compute_cosine_block(cosine_features, (i0, i1, i0, len(tokens)), distances.dtype)
+            distances[i0:i1, i0:] = block
+            distances[i0:, i0:i1] = block.T
+
+    # computes the distance matrices of several metrics in a single pass over the tiles of the matrix, possibly over a
+    # pool of worker processes. the per-token features of the metrics are derived once, and the metrics computed pair
+    # by pair share a single iteration over the pairs. returns a dictionary that maps each metric to its matrix
+    def get_fused_distances(self, tokens, distance_metrics, ngrams):
+        start_time = time.time()
+        tokens = list(tokens)
+        # ngrams only applies to cosine distances
+        metric_ngrams = {metric: ngrams if metric == Distance.COSINE.value else None for metric in distance_metrics}
+        all_distances = dict()
+        for distance_metric in metric_ngrams:
+            distances = self.load_computed_distances(tokens, distance_metric, metric_ngrams[distance_metric])
+            if distances is not None:
+                all_distances[distance_metric] = distances
+        missing_metrics = [metric for metric in metric_ngrams if metric not in all_distances]
+        if missing_metrics:
+            for distance_metric in missing_metrics:
+                get_distance_function(distance_metric, ngrams)  # fails on unknown distance metrics
+                all_distances[distance_metric] = self.allocate_distances(tokens, distance_metric,
+                                                                         metric_ngrams[distance_metric])
+            tiles = self.get_tiles(len(tokens))
+            dtypes = {metric: all_distances[metric].dtype for metric in missing_metrics}
+            initargs = (tokens, missing_metrics, ngrams, dtypes, self.kernel)
+            if self.workers > 1 and len(tiles) > 1:
+                with ProcessPoolExecutor(max_workers=self.workers, initializer=init_fused_worker,
+                                         initargs=initargs) as executor:
+                    self.write_fused_tiles(all_distances, executor.map(compute_fused_tile, tiles))
+            else:
+                init_fused_worker(*initargs)
+                self.write_fused_tiles(all_distances, map(compute_fused_tile, tiles))
+            for distance_metric in missing_metrics:
+                all_distances[distance_metric] = self.save_computed_distances(
+                    all_distances[distance_metric], tokens, distance_metric, metric_ngrams[distance_metric])
+            end_time = time.time()
+            logging.info("Fused " + ", ".join(missing_metrics) + " distances computation time: " +
+                         str(round(end_time-start_time, 2)) + " seconds")
+        return all_distances
+
+    # computes the upper triangle of the pairwise distances matrix as a condensed vector (in the order of
+    # scipy.spatial.distance.pdist), which takes half the memory of the square matrix. blocks of rows are computed
+    # against the tokens from their first row onwards, possibly over a pool of worker processes
+    def get_condensed_distances(self, tokens, distance_metric, ngrams=None):
+        start_time = time.time()
+        tokens = list(tokens)
+        size = len(tokens)
+        get_distance_function(distance_metric, ngrams)  # fails on unknown distance metrics
+        dtype = get_distance_dtype(tokens, distance_metric)
+        distances = np.empty(size * (size - 1) // 2, dtype=dtype)
+        tiles = [(i0, min(i0 + self.tile_size, size), i0, size) for i0 in range(0, size, self.tile_size)]
+        initargs = (tokens, [distance_metric], ngrams, {distance_metric: dtype}, self.kernel)
+        if self.workers > 1 and len(tiles) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_fused_worker,
+                                     initargs=initargs) as executor:
+                self.write_condensed_tiles(distances, size, executor.map(compute_fused_tile, tiles))
+        else:
+            init_fused_worker(*initargs)
+            self.write_condensed_tiles(distances, size, map(compute_fused_tile, tiles))
+        end_time = time.time()
+        logging.info("Condensed " + distance_metric + " distances computation time: " +
+                     str(round(end_time-start_time, 2)) + " seconds")
+        return distances
+
+    # writes the part of each block of rows above the diagonal into a condensed distances vector
+    @staticmethod
+    def write_condensed_tiles(distances, size, results):
+        for (i0, i1, j0, j1), blocks in results:
+            for block in blocks.values():
+                for i in range(i0, i1):
+                    start = i * (2 * size - i - 1) // 2
+                    distances[start:start + size - i - 1] = block[i - i0, i + 1 - j0:]
+
+    def write_fused_tiles(self, all_distances, results):
+        for tile, blocks in results:
+            for distance_metric, block in blocks.items():
+                self.write_tiles(all_distances[distance_metric], [(tile, block)])
+
+    # updates the distances matrix previously computed for previous_tokens to the given tokens: the rows and columns
+    # of removed tokens are dropped, those of the tokens that are kept are copied, and only the distances involving
+    # new tokens are computed. returns the updated matrix and its token index, which lists the kept and new tokens in
+    # sorted order, like the token index of a matrix computed anew, so that the updated matrix is reused by later runs
+    # in out-of-core mode (and added to the cache, if any)
+    def update_distances(self, previous_distances, previous_tokens, tokens, distance_metric, ngrams=None):
+        start_time = time.time()
+        tokens = set(tokens)
+        kept = np.array([i for i, token in enumerate(previous_tokens) if token in tokens], dtype=np.intp)
+        previous_tokens = list(previous_tokens)
+        added = sorted(tokens.difference(previous_tokens))
+        # distances are computed over the kept tokens followed by the new ones, and written to the sorted positions
+        # of the tokens in the updated matrix
+        computed_tokens = [previous_tokens[i] for i in kept] + added
+        updated_tokens = sorted(computed_tokens)
+        ranks = {token: rank for rank, token in enumerate(updated_tokens)}
+        positions = np.array([ranks[token] for token in computed_tokens], dtype=np.intp)
+        distances = self.allocate_distances(updated_tokens, distance_metric, ngrams)
+        for i0 in range(0, len(kept), self.tile_size):
+            i1 = min(i0 + self.tile_size, len(kept))
+            distances[np.ix_(positions[i0:i1], positions[:len(kept)])] = previous_distances[kept[i0:i1]][:, kept]
+        self.fill_tile_distances(distances, computed_tokens, distance_metric, ngrams, start=len(kept),
+                                 positions=positions)
+        distances = self.save_computed_distances(distances, updated_tokens, distance_metric, ngrams)
+        end_time = time.time()
+        logging.info("Updated " + distance_metric + " distances (" + str(len(previous_tokens) - len(kept)) +
+                     " tokens removed, " + str(len(added)) + " added) in " + str(round(end_time-start_time, 2)) +
+                     " seconds")
+        return distances, updated_tokens
+
+    # updates the distances matrix of the memmap folder, computed for other tokens, to the given (sorted) tokens, in
+    # place. returns None if there is no such matrix
+    def update_memmap_distances(self, tokens, distance_metric, ngrams):
+        matrix_file, tokens_file = self.get_memmap_files(distance_metric, ngrams)
+        if not os.path.exists(matrix_file) or not os.path.exists(tokens_file) or list(tokens) != sorted(tokens):
+            return None
+        logging.info("Updating distances matrix: " + matrix_file)
+        previous_distances, previous_tokens = self.load_distances(matrix_file, tokens_file)
+        return self.update_distances(previous_distances, previous_tokens, tokens, distance_metric, ngrams)[0]
+
+    # loads a distances matrix and its token index, as saved in out-of-core mode or by StringClusters, so that they
+    # can be updated or clustered again. .npy matrices are memory-mapped rather than read into memory
+    @staticmethod
+    def load_distances(matrix_file, tokens_file):
+        if matrix_file.endswith(".npz"):
+            with np.load(matrix_file) as matrix:
+                # sparse matrices are saved with their CSR arrays, and dense ones as a single array
+                distances = scipy.sparse.load_npz(matrix_file) if "indptr" in matrix else matrix["distances"]
+            return distances, StringUtils.parse_file(tokens_file)
+        return np.load(matrix_file, mmap_mode='r'), StringUtils.parse_file(tokens_file)
+
+    # returns the paths of the memory-mapped distances matrix of the given metric and of its token index
+    def get_memmap_files(self, distance_metric, ngrams):
+        name = self.memmap_folder + "distances_" + distance_metric
+        if distance_metric == Distance.COSINE.value:
+            name += "_" + str(ngrams)
+        return name + ".npy", name + ".tokens"
+
+    # returns a read-only memory map of a previously computed distances matrix, or None if there is no matrix
+    # computed for exactly the same tokens
+    def load_memmap_distances(self, tokens, distance_metric, ngrams):
+        matrix_file, tokens_file = self.get_memmap_files(distance_metric, ngrams)
+        if os.path.exists(matrix_file) and os.path.exists(tokens_file) and \
+                StringUtils.parse_file(tokens_file) == tokens:
+            logging.info("Reusing distances matrix: " + matrix_file)
+            return np.load(matrix_file, mmap_mode='r')
+        return None
+
+    # allocates an uninitialized distances matrix, either in memory or, in out-of-core mode, as a memory-mapped file.
+    # the file is filled under a temporary name so that an interrupted run never leaves behind a matrix to be reused
+    def allocate_distances(self, tokens, distance_metric, ngrams):
+        shape = (len(tokens), len(tokens))
+        dtype = get_distance_dtype(tokens, distance_metric)
+        if self.memmap_folder is None:
+            return np.empty(shape, dtype=dtype)
+        matrix_file, _ = self.get_memmap_files(distance_metric, ngrams)
+        return np.lib.format.open_memmap(matrix_file + ".part", mode='w+', dtype=dtype, shape=shape)
+
+    # in out-of-core mode, flushes the filled matrix to disk, saves its token index, and returns a read-only
+    # memory map of the matrix
+    def finalize_distances(self, distances, tokens, distance_metric, ngrams):
+        if self.memmap_folder is None:
+            return distances
+        matrix_file, tokens_file = self.get_memmap_files(distance_metric, ngrams)
+        distances.flush()
+        del distances
+        if os.path.exists(tokens_file):
+            os.remove(tokens_file)
+        os.replace(matrix_file + ".part", matrix_file)
+        StringUtils.save_list_to_file(tokens_file, tokens)
+        logging.info("Saved distances matrix: " + matrix_file)
+        return np.load(matrix_file, mmap_mode='r')
+
+    # writes each tile, and its mirror image, into the distances matrix. if positions are given, the i-th token of the
+    # tiles is written to row and column positions[i] of the matrix
+    @staticmethod
+    def write_tiles(distances, results, positions=None):
+        for (i0, i1, j0, j1), block in results:
+            if positions is None:
+                distances[i0:i1, j0:j1] = block
+                distances[j0:j1, i0:i1] = block.T
+            else:
+                distances[np.ix_(positions[i0:i1], positions[j0:j1])] = block
+                distances[np.ix_(positions[j0:j1], positions[i0:i1])] = block.T
+
     # takes a collection of tokens and computes the pairwise distance between all tokens,
     # according to the specified distance metric
     def get_distances(self, tokens, distance_metric, ngrams):
@@ -91,3 +914,167 @@ class StringDistance:
             raise ValueError("Unknown distance metric input: '" + distance_metric + "'. Supported values are: " +
                              str([distance.value for distance in Distance]))
         return distances
+
+    # takes a collection of tokens and computes only the distances of at most max_distance between them, according to
+    # the specified edit distance metric, or to jaccard (see get_thresholded_jaccard_distances) or cosine distances
+    # (see get_joined_distances). returns a sparse (CSR) matrix where pairs of tokens further apart than max_distance,
+    # as well as the diagonal, are not stored
+    def get_sparse_distances(self, tokens, distance_metric, max_distance, q=2, ngrams=None):
+        if distance_metric == Distance.JACCARD.value and len(get_alphabet(tokens)) <= 64:
+            return self.get_thresholded_jaccard_distances(tokens, max_distance)
+        if distance_metric == Distance.JACCARD.value or distance_metric == Distance.COSINE.value:
+            return self.get_joined_distances(tokens, distance_metric, max_distance, ngrams)
+        start_time = time.time()
+        if distance_metric == Distance.LEVENSHTEIN.value:
+            verify = bounded_levenshtein_distance
+            filter_distance = max_distance
+        elif distance_metric == Distance.DAMERAU_LEVENSHTEIN.value:
+            verify = lambda w1, w2, k: jellyfish.damerau_levenshtein_distance(w1, w2)
+            # a transposition amounts to two Levenshtein edits, so the filters must allow for twice as many edits
+            filter_distance = 2 * max_distance
+        else:
+            raise ValueError("Sparse distances are only supported for edit and set-based distances: " +
+                             str([Distance.LEVENSHTEIN.value, Distance.DAMERAU_LEVENSHTEIN.value,
+                                  Distance.JACCARD.value, Distance.COSINE.value]))
+        tokens = list(tokens)
+        rows, cols, data = [], [], []
+        for i, j in self.get_candidate_pairs(tokens, filter_distance, q):
+            distance = verify(tokens[i], tokens[j], max_distance)
+            if distance <= max_distance:
+                rows += [i, j]
+                cols += [j, i]
+                data += [distance, distance]
+        distances = scipy.sparse.csr_matrix((np.array(data, dtype=np.min_scalar_type(max_distance)), (rows, cols)),
+                                            shape=(len(tokens), len(tokens)))
+        end_time = time.time()
+        logging.info("Sparse " + distance_metric + " distances computation time: " +
+                     str(round(end_time-start_time, 2)) + " seconds (" + str(len(data)) + " pairs within distance " +
+                     str(max_distance) + ")")
+        return distances
+
+    # takes a collection of tokens and computes the jaccard distances of at most max_distance between them, as a sparse
+    # (CSR) matrix, from the blocks of rows of the dense matrix computed from character masks (as in
+    # fill_jaccard_distances), which are thresholded one at a time so that the dense matrix is never held in memory.
+    # every pair is compared, but with a few bitwise operations: the characters of the tokens come from such a small
+    # alphabet that a similarity join would prune few pairs, at a much higher cost per pair
+    def get_thresholded_jaccard_distances(self, tokens, max_distance):
+        start_time = time.time()
+        tokens = list(tokens)
+        masks = get_character_masks(tokens)
+        dtype = get_distance_dtype(tokens, Distance.JACCARD.value)
+        rows, cols, data = [], [], []
+        for i0 in range(0, len(tokens), self.tile_size):
+            i1 = min(i0 + self.tile_size, len(tokens))
+            block = compute_jaccard_block(masks, (i0, i1, i0, len(tokens)), dtype)
+            block_rows, block_cols = np.nonzero(block <= max_distance)
+            # the block starts at the diagonal, and only the pairs above it are kept
+            upper = block_cols > block_rows
+            block_rows, block_cols = block_rows[upper], block_cols[upper]
+            rows.append(block_rows + i0)
+            cols.append(block_cols + i0)
+            data.append(block[block_rows, block_cols])
+        rows, cols = np.concatenate(rows or [[]]).astype(np.int64), np.concatenate(cols or [[]]).astype(np.int64)
+        data = np.concatenate(data or [[]]).astype(np.min_scalar_type(max_distance))
+        distances = scipy.sparse.csr_matrix((np.r_[data, data], (np.r_[rows, cols], np.r_[cols, rows])),
+                                            shape=(len(tokens), len(tokens)))
+        end_time = time.time()
+        logging.info("Thresholded jaccard distances computation time: " + str(round(end_time-start_time, 2)) +
+                     " seconds (" + str(len(data)) + " pairs within distance " + str(max_distance) + ")")
+        return distances
+
+    # takes a collection of tokens and computes exactly the jaccard or cosine distances of at most max_distance between
+    # them, as a sparse (CSR) matrix, with a similarity join that does not compare every pair of tokens. the features
+    # of the tokens (characters for jaccard, n-grams for cosine) are ordered from the rarest to the most frequent, and
+    # only the leading features of each token are indexed (see get_prefix_join_pairs)
+    def get_joined_distances(self, tokens, distance_metric, max_distance, ngrams=None):
+        start_time = time.time()
+        if distance_metric == Distance.JACCARD.value:
+            features = get_character_sets(tokens)
+        elif distance_metric == Distance.COSINE.value:
+            features = get_ngram_profiles(tokens, ngrams)
+        else:
+            raise ValueError("Similarity joins are only supported for set-based distances: " +
+                             str([Distance.JACCARD.value, Distance.COSINE.value]))
+        if not 0 <= max_distance < 100:
+            raise ValueError("The maximum distance of a similarity join must be between 0 and 99")
+        tokens = list(tokens)
+        # distances of at most max_distance are those of similarities above this threshold, which is lowered slightly
+        # so that rounding errors in the filters never discard a pair
+        threshold = 1.0 - (max_distance + 1) / 100.0 - 1e-9
+        rows, cols = get_prefix_join_pairs(features, threshold, distance_metric == Distance.COSINE.value)
+        data = compute_pair_distances(tokens, distance_metric, ngrams, rows, cols)
+        close = data <= max_distance
+        rows, cols, data = rows[close], cols[close], data[close].astype(np.min_scalar_type(max_distance))
+        distances = scipy.sparse.csr_matrix((np.r_[data, data], (np.r_[rows, cols], np.r_[cols, rows])),
+                                            shape=(len(tokens), len(tokens)))
+        end_time = time.time()
+        logging.info("Joined " + distance_metric + " distances computation time: " +
+                     str(round(end_time-start_time, 2)) + " seconds (" + str(len(data)) + " pairs within distance " +
+                     str(max_distance) + ", out of " + str(len(close)) + " candidate pairs)")
+        return distances
+
+    # takes a collection of tokens and approximates the sparse matrix of jaccard or cosine distances of at most
+    # max_distance between them with MinHash locality-sensitive hashing. the MinHash signatures of num_perm values are
+    # split into bands, and only the pairs of tokens that agree on a whole band are compared, exactly. more bands (of
+    # fewer rows each) find more of the close pairs, at the cost of more candidates to compare, and band buckets of
+    # more than max_bucket_size tokens are skipped (see get_lsh_candidate_pairs). signatures are computed over the
+    # character n-grams of the tokens for both metrics: the characters alone, which jaccard distances compare, are so
+    # few that most tokens would share whole bands. tokens that share many n-grams also share most of their characters,
+    # but not the other way around, so jaccard candidates miss more of the close pairs than cosine candidates do
+    def get_approximate_distances(self, tokens, distance_metric, max_distance, ngrams=None, num_perm=128, bands=32,
+                                  seed=0, max_bucket_size=1000):
+        start_time = time.time()
+        if distance_metric == Distance.JACCARD.value or distance_metric == Distance.COSINE.value:
+            shingles = get_ngram_profiles(tokens, ngrams)
+        else:
+            raise ValueError("Approximate distances are only supported for set-based distances: " +
+                             str([Distance.JACCARD.value, Distance.COSINE.value]))
+        if num_perm % bands != 0:
+            raise ValueError("The number of permutations (" + str(num_perm) + ") must be a multiple of the number "
+                             "of bands (" + str(bands) + ")")
+        tokens = list(tokens)
+        signatures = get_minhash_signatures(shingles, num_perm, seed)
+        # tokens without n-grams are never candidates
+        rows, cols = get_lsh_candidate_pairs(signatures, bands, np.flatnonzero(np.diff(shingles.indptr)),
+                                             max_bucket_size)
+        data = compute_pair_distances(tokens, distance_metric, ngrams, rows, cols)
+        close = data <= max_distance
+        rows, cols, data = rows[close], cols[close], data[close].astype(np.min_scalar_type(max_distance))
+        distances = scipy.sparse.csr_matrix((np.r_[data, data], (np.r_[rows, cols], np.r_[cols, rows])),
+                                            shape=(len(tokens), len(tokens)))
+        end_time = time.time()
+        logging.info("Approximate " + distance_metric + " distances computation time: " +
+                     str(round(end_time-start_time, 2)) + " seconds (" + str(len(data)) + " pairs within distance " +
+                     str(max_distance) + ", out of " + str(len(close)) + " candidate pairs)")
+        return distances
+
+    # generates the pairs of tokens that may be within max_distance edits of each other. tokens are visited by
+    # increasing length, and pairs are discarded if their lengths differ by more than max_distance or if they share
+    # fewer q-grams than max(|w1|,|w2|) - q + 1 - max_distance*q (the q-gram count filter). tokens that are too short
+    # for that bound to be positive are compared with every other short token
+    @staticmethod
+    def get_candidate_pairs(tokens, max_distance, q):
+        short_length = (max_distance + 1) * q - 1
+        index = dict()  # q-gram -> list of (token, q-gram count), in increasing order of token length
+        index_start = dict()  # q-gram -> position of the first entry in the index that passes the length filter
+        short_tokens = []
+        for i in sorted(range(len(tokens)), key=lambda t: len(tokens[t])):
+            length = len(tokens[i])
+            shared = Counter()
+            for qgram, count in get_qgram_profile(tokens[i], q).items():
+                entries = index.setdefault(qgram, [])
+                start = index_start.get(qgram, 0)
+                while start < len(entries) and len(tokens[entries[start][0]]) < length - max_distance:
+                    start += 1
+                index_start[qgram] = start
+                for j, other_count in entries[start:]:
+                    shared[j] += min(count, other_count)
+                entries.append((i, count))
+            for j, count in shared.items():
+                if count >= length - q + 1 - max_distance * q:
+                    yield j, i
+            if length <= short_length:
+                for j in short_tokens:
+                    if j not in shared and length - len(tokens[j]) <= max_distance:
+                        yield j, i
+                short_tokens.append(i)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Provides StringEmbedding class"""
+
+import logging
+import time
+
+import numpy as np
+import sklearn.decomposition
+import sklearn.feature_extraction.text
+import sklearn.preprocessing
+
+__author__ = "Rafael Gonçalves, Stanford University"
+
+
+class StringEmbedding:
+
+    # tokens are embedded into vectors of the given number of dimensions. n-gram vectors hash the n-grams of the
+    # tokens into n_features columns, so that no vocabulary is kept in memory
+    def __init__(self, ngrams=4, dimensions=64, n_features=2**18, seed=0):
+        self.ngrams = ngrams
+        self.dimensions = dimensions
+        self.n_features = n_features
+        self.seed = seed
+        logging.basicConfig(level=logging.INFO)
+
+    # embeds the tokens as the TF-IDF weights of their hashed character n-grams (ignoring white space, as cosine
+    # distances do), reduced to the given number of dimensions with a truncated SVD, and normalized to unit length, so
+    # that the Euclidean distance between two vectors grows with the cosine distance between them
+    def get_ngram_vectors(self, tokens):
+        start_time = time.time()
+        vectorizer = sklearn.feature_extraction.text.HashingVectorizer(
+            analyzer='char', ngram_range=(self.ngrams, self.ngrams), n_features=self.n_features,
+            alternate_sign=False, norm=None, lowercase=False, preprocessor=lambda token: "".join(token.split()))
+        counts = vectorizer.transform(tokens)
+        weights = sklearn.feature_extraction.text.TfidfTransformer(sublinear_tf=True).fit_transform(counts)
+        # most hashed n-grams never occur, and only make the SVD slower
+        weights = weights[:, np.unique(weights.indices)]
+        dimensions = max(min(self.dimensions, weights.shape[0] - 1, weights.shape[1] - 1), 1)
+        svd = sklearn.decomposition.TruncatedSVD(n_components=dimensions, random_state=self.seed)
+        vectors = sklearn.preprocessing.normalize(svd.fit_transform(weights))
+        end_time = time.time()
+        logging.info("N-gram embedding time: " + str(round(end_time-start_time, 2)) + " seconds (" + str(dimensions) +
+                     " dimensions)")
+        return vectors.astype(np.float32)
+
+    # embeds the rows of a dense distances matrix (which may be memory-mapped, as it is only read a block of rows at a
+    # time) into the given number of dimensions: the rows are first reduced to their distances to a random sample of
+    # landmark tokens, a sample of the columns of the matrix that roughly preserves the Euclidean distances between
+    # rows (scaled down by the square root of the fraction of columns sampled), whose principal components are then
+    # kept
+    def get_landmark_vectors(self, distances, landmarks=None, block_size=1024):
+        start_time = time.time()
+        size = distances.shape[0]
+        if landmarks is None:
+            landmarks = 10 * self.dimensions
+        landmarks = np.sort(np.random.RandomState(self.seed).permutation(size)[:min(landmarks, size)])
+        landmark_distances = np.empty((size, len(landmarks)), dtype=np.float32)
+        for i0 in range(0, size, block_size):
+            landmark_distances[i0:i0+block_size] = np.asarray(distances[i0:i0+block_size])[:, landmarks]
+        dimensions = max(min(self.dimensions, size, len(landmarks)), 1)
+        pca = sklearn.decomposition.PCA(n_components=dimensions, random_state=self.seed)
+        vectors = pca.fit_transform(landmark_distances).astype(np.float32)
+        end_time = time.time()
+        logging.info("Landmark embedding time: " + str(round(end_time-start_time, 2)) + " seconds (" +
+                     str(len(landmarks)) + " landmarks, " + str(dimensions) + " dimensions)")
+        return vectors
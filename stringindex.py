@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Provides StringIndex class.
+
+StringIndex is a BK-tree over normalized strings, which finds the indexed strings within a given distance of a query
+string, or its nearest indexed strings, without comparing the query with every indexed string.
+
+Example usage:
+    ```
+    index = StringIndex('levenshtein')
+    index.add_tokens(StringUtils.parse_file("foods.txt"))
+    index.range_search("banana", 2)  # [(token, distance), ...] of the tokens within 2 edits of "banana"
+    index.nearest("banana", 5)  # [(token, distance), ...] of the 5 tokens closest to "banana"
+    ```
+"""
+
+import heapq
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from stringdistance import Distance, get_distance_function
+from stringnormalize import StringNormalize
+
+__author__ = "Rafael Gonçalves, Stanford University"
+
+
+# index of a batch query worker process, set once per process by init_query_worker
+_worker_index = None
+
+
+def init_query_worker(index):
+    global _worker_index
+    _worker_index = index
+
+
+def range_search_worker(args):
+    return _worker_index.range_search(*args)
+
+
+def nearest_worker(args):
+    return _worker_index.nearest(*args)
+
+
+class StringIndex:
+
+    # a BK-tree prunes its search using the triangle inequality, which holds for the levenshtein and damerau edit
+    # distances, and, up to 1 after quantization to 0-100, for the jaccard distance. slack widens the pruning bounds by
+    # that many distance units. jaro, jaro-winkler and cosine distances are not metrics, so by default searches over
+    # them are not pruned at all, and compare the query with every token. a finite slack may be given to prune them
+    # anyway, which trades recall for speed, as such searches may then miss some results
+    def __init__(self, distance_metric, ngrams=4, slack=None):
+        self.distance_metric = distance_metric
+        self.ngrams = ngrams
+        self.distance_function = get_distance_function(distance_metric, ngrams)
+        if slack is None:
+            if distance_metric in (Distance.LEVENSHTEIN.value, Distance.DAMERAU_LEVENSHTEIN.value):
+                slack = 0
+            elif distance_metric == Distance.JACCARD.value:
+                slack = 1
+            else:
+                logging.warning(distance_metric + " distances are not a metric: searches compare the query with every "
+                                "token, unless a slack is given")
+                slack = float("inf")
+        self.slack = slack
+        self.normalizer = StringNormalize()
+        self.tokens = []
+        # the tree is stored as the parent of each token (-1 for the root) and its distance to that parent, from
+        # which the children of each token, keyed by their distance to it, are derived
+        self.parents = []
+        self.edges = []
+        self.children = []
+        logging.basicConfig(level=logging.INFO)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    # the distance function of cosine distances is a closure, so it is rebuilt when the index is unpickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["distance_function"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.distance_function = get_distance_function(self.distance_metric, self.ngrams)
+
+    # normalizes the given strings and adds those that are not yet indexed to the tree
+    def add_tokens(self, tokens):
+        start_time = time.time()
+        for token in sorted(self.normalizer.normalize_tokens(tokens)):
+            self.add_token(token)
+        end_time = time.time()
+        logging.info("String index construction time: " + str(round(end_time-start_time, 2)) + " seconds (" +
+                     str(len(self.tokens)) + " tokens)")
+
+    def add_token(self, token):
+        if not self.tokens:
+            self.append_node(token, -1, 0)
+            return
+        node = 0
+        while True:
+            distance = self.distance_function(token, self.tokens[node])
+            if distance == 0 and token == self.tokens[node]:
+                return
+            child = self.children[node].get(distance)
+            if child is None:
+                self.append_node(token, node, distance)
+                return
+            node = child
+
+    def append_node(self, token, parent, edge):
+        self.tokens.append(token)
+        self.parents.append(parent)
+        self.edges.append(edge)
+        self.children.append(dict())
+        if parent >= 0:
+            self.children[parent][edge] = len(self.tokens) - 1
+
+    # returns the indexed tokens within max_distance of the (normalized) query, as a list of (token, distance) sorted
+    # by distance
+    def range_search(self, query, max_distance):
+        query = self.normalizer.normalize(query)
+        results = []
+        nodes = [0] if self.tokens else []
+        while nodes:
+            node = nodes.pop()
+            distance = self.distance_function(query, self.tokens[node])
+            if distance <= max_distance:
+                results.append((self.tokens[node], distance))
+            low = distance - max_distance - self.slack
+            high = distance + max_distance + self.slack
+            nodes.extend(child for edge, child in self.children[node].items() if low <= edge <= high)
+        return sorted(results, key=lambda result: (result[1], result[0]))
+
+    # returns the k indexed tokens nearest to the (normalized) query, as a list of (token, distance) sorted by
+    # distance. the search radius shrinks to the distance of the k-th nearest token found so far
+    def nearest(self, query, k):
+        query = self.normalizer.normalize(query)
+        best = []  # heap of (-distance, token) of the k nearest tokens found so far
+        nodes = [0] if self.tokens and k > 0 else []
+        while nodes:
+            node = nodes.pop()
+            distance = self.distance_function(query, self.tokens[node])
+            if len(best) < k:
+                heapq.heappush(best, (-distance, self.tokens[node]))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, self.tokens[node]))
+            radius = -best[0][0] if len(best) == k else float("inf")
+            low = distance - radius - self.slack
+            high = distance + radius + self.slack
+            nodes.extend(child for edge, child in self.children[node].items() if low <= edge <= high)
+        return sorted([(token, -distance) for distance, token in best], key=lambda result: (result[1], result[0]))
+
+    # batched range searches, possibly over a pool of worker processes. returns a list of results per query
+    def range_search_many(self, queries, max_distance, workers=1):
+        return self.query_many(range_search_worker, [(query, max_distance) for query in queries], workers)
+
+    # batched nearest neighbor searches, possibly over a pool of worker processes. returns a list of results per query
+    def nearest_many(self, queries, k, workers=1):
+        return self.query_many(nearest_worker, [(query, k) for query in queries], workers)
+
+    def query_many(self, worker, queries, workers):
+        if workers > 1 and len(queries) > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_query_worker,
+                                     initargs=(self,)) as executor:
+                return list(executor.map(worker, queries, chunksize=max(1, len(queries) // (4 * workers))))
+        init_query_worker(self)
+        return [worker(query) for query in queries]
+
+    # saves the index to a compressed .npz file
+    def save(self, output_file):
+        np.savez_compressed(output_file, tokens=np.array(self.tokens, dtype=str), parents=np.array(self.parents),
+                            edges=np.array(self.edges), distance_metric=self.distance_metric, ngrams=self.ngrams,
+                            slack=self.slack)
+
+    # loads an index saved with save()
+    @staticmethod
+    def load(input_file):
+        with np.load(input_file) as data:
+            slack = float(data["slack"])
+            index = StringIndex(str(data["distance_metric"]), int(data["ngrams"]),
+                                int(slack) if np.isfinite(slack) else slack)
+            for token, parent, edge in zip(data["tokens"].tolist(), data["parents"].tolist(), data["edges"].tolist()):
+                index.append_node(token, parent, edge)
+        return index
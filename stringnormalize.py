@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 """Provides StringNormalize class"""
 
+import functools
+import itertools
 import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 
 __author__ = "Rafael Gonçalves, Stanford University"
 
@@ -9,34 +13,88 @@ __author__ = "Rafael Gonçalves, Stanford University"
 class StringNormalize:
 
     def __init__(self):
-        self.pattern = re.compile('([^\s\w]|_)+')
+        self.pattern = re.compile(r'([^\s\w]|_)+')
         self.first_cap_re = re.compile('(.)([A-Z][a-z]+)')
         self.all_cap_re = re.compile('([a-z0-9])([A-Z])')
         self.numbers_re = re.compile('[0-9]+')
+        self.whitespace_re = re.compile(r'\s+')
+        self.separators_re = re.compile('[-_]')
+        self.separators_table = str.maketrans('-_', '  ')
 
-    def normalize_tokens(self, tokens):
+    def normalize_tokens(self, tokens, workers=1):
         normalized_tokens = set()
-        for token in tokens:
-            normalized_token = self.normalize(token)
+        for normalized_token in self.normalize_many(tokens, workers):
             if normalized_token != "" and len("".join(normalized_token.split())) > 3:
                 normalized_tokens.add(normalized_token)
         return normalized_tokens
 
+    # normalizes the tokens as normalize_tokens does, one at a time (so tokens may be a generator, such as the lines
+    # of a file being read), and returns the number of occurrences of each distinct normalized token
+    def count_tokens(self, tokens, workers=1):
+        token_counts = Counter()
+        for normalized_token in self.normalize_many(tokens, workers):
+            if normalized_token != "" and len("".join(normalized_token.split())) > 3:
+                token_counts[normalized_token] += 1
+        return token_counts
+
     # replace all non-alphanumeric characters with spaces, and trim all extra white space
     def normalize(self, token):
         token = self.parse_camel_case(token)
         token = self.pattern.sub(' ', token)
         token = self.numbers_re.sub('', token)
         token = self.to_ascii(token)
-        token = re.sub('\s+', ' ', token).strip()
+        token = self.whitespace_re.sub(' ', token).strip()
         return token
 
+    # yields the normalized form of each token, in order, exactly as normalize gives it. repeated tokens are normalized
+    # once, as long as they are among the last cache_size distinct tokens. if workers > 1, chunks of chunk_size tokens
+    # are normalized over a pool of worker processes, with a bounded number of chunks in flight so that tokens may be
+    # a generator of any length
+    def normalize_many(self, tokens, workers=1, cache_size=65536, chunk_size=10000):
+        if workers <= 1:
+            normalize = functools.lru_cache(maxsize=cache_size)(self.normalize)
+            for token in tokens:
+                yield normalize(token)
+            return
+        tokens = iter(tokens)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_normalize_worker,
+                                 initargs=(cache_size,)) as executor:
+            pending = deque()
+            for chunk in iter(lambda: list(itertools.islice(tokens, chunk_size)), []):
+                pending.append(executor.submit(normalize_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
     def parse_camel_case(self, name):
-        s1 = self.first_cap_re.sub(r'\1_\2', name)
-        s2 = self.all_cap_re.sub(r'\1_\2', s1).lower()
-        pparts = re.split("[-_]", s2)
+        s2 = name.lower()
+        # the camel case patterns only apply to names with upper-case letters, which lower-casing changes
+        if s2 != name:
+            s1 = self.first_cap_re.sub(r'\1_\2', name)
+            s2 = self.all_cap_re.sub(r'\1_\2', s1).lower()
+        # title-casing and lower-casing again only changes non-ASCII words (e.g. 'ß' becomes 'ss')
+        if s2.isascii():
+            return s2.translate(self.separators_table)
+        pparts = self.separators_re.split(s2)
         name = " ".join([x.title() for x in pparts])
         return name.lower()
 
     def to_ascii(self, string):
+        if string.isascii():
+            return string
         return string.encode("ascii", errors="ignore").decode()
+
+
+# normalization function of a worker process of StringNormalize.normalize_many, set once per process by
+# init_normalize_worker
+_worker_normalize = None
+
+
+def init_normalize_worker(cache_size):
+    global _worker_normalize
+    _worker_normalize = functools.lru_cache(maxsize=cache_size)(StringNormalize().normalize)
+
+
+def normalize_chunk(tokens):
+    return [_worker_normalize(token) for token in tokens]
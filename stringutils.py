@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 """Provides StringUtils class"""
 
+import bz2
+import gzip
 import json
+import lzma
 import re
 
 __author__ = "Rafael Gonçalves, Stanford University"
@@ -15,9 +18,26 @@ class StringUtils:
 
     @staticmethod
     def parse_file(input_file):
-        file = open(input_file)
-        lines = file.read().splitlines()
-        return lines
+        return list(StringUtils.read_lines(input_file))
+
+    # yields the lines of a text file one at a time, without their line breaks. files ending in .gz, .bz2 or .xz are
+    # decompressed as they are read. each line read is split again with str.splitlines, so that lines are broken at
+    # the same boundaries (such as \v, \f or \x85) as by reading the whole file and splitting it
+    @staticmethod
+    def read_lines(input_file):
+        with StringUtils.open_file(input_file) as file:
+            for line in file:
+                yield from line.splitlines()
+
+    @staticmethod
+    def open_file(input_file, mode='rt'):
+        if input_file.endswith(".gz"):
+            return gzip.open(input_file, mode)
+        elif input_file.endswith(".bz2"):
+            return bz2.open(input_file, mode)
+        elif input_file.endswith(".xz"):
+            return lzma.open(input_file, mode)
+        return open(input_file, mode)
 
     @staticmethod
     def parse_cluster_dict(cluster_dict):
@@ -36,11 +56,45 @@ class StringUtils:
         with open(output_file, mode) as f:
             f.write(line + '\n')
 
+    # writes the JSON of the dictionary as it is encoded, rather than building the whole JSON string first
     @staticmethod
     def save_dictionary_as_json(output_file, output):
-        output_file = open(output_file, "w+")
-        output_file.write(StringUtils.get_dictionary_as_json(output))
-        output_file.close()
+        with open(output_file, "w+") as f:
+            json.dump(output, f, sort_keys=True, indent=2)
+
+    # writes a dictionary as JSON without white space, one entry at a time (recursively, for nested dictionaries)
+    @staticmethod
+    def save_dictionary_as_compact_json(output_file, output):
+        with open(output_file, "w+") as f:
+            StringUtils.write_compact_json(f, output)
+
+    @staticmethod
+    def write_compact_json(f, dictionary):
+        f.write("{")
+        for i, key in enumerate(sorted(dictionary)):
+            # JSON keys are strings, and other keys are converted as the json module converts them
+            f.write(("," if i else "") + json.dumps(key if isinstance(key, str) else json.dumps(key)) + ":")
+            if isinstance(dictionary[key], dict):
+                StringUtils.write_compact_json(f, dictionary[key])
+            else:
+                f.write(json.dumps(dictionary[key], separators=(",", ":")))
+        f.write("}")
+
+    # writes a nested dictionary as JSON Lines, with one line per innermost value. each line is an object that maps
+    # key_names to the keys leading to the value, and value_name to the value
+    @staticmethod
+    def save_dictionary_as_json_lines(output_file, output, key_names, value_name):
+        with open(output_file, "w+") as f:
+            StringUtils.write_json_lines(f, output, key_names, value_name, dict())
+
+    @staticmethod
+    def write_json_lines(f, dictionary, key_names, value_name, keys):
+        for key in sorted(dictionary):
+            keys[key_names[0]] = key
+            if len(key_names) > 1:
+                StringUtils.write_json_lines(f, dictionary[key], key_names[1:], value_name, keys)
+            else:
+                f.write(json.dumps(dict(keys, **{value_name: dictionary[key]})) + "\n")
 
     @staticmethod
     def tokenize_multi_word_strings(tokens):